@@ -2,8 +2,12 @@
 
 __author__ = 'litnimax@asteriskguru.ru'
 
+import Queue
 import sys
+import tempfile
+import threading
 import time
+import urllib
 from multiprocessing import Process
 from urlparse import urljoin
 
@@ -14,15 +18,104 @@ import agent_config as config
 from util import *
 
 logger = get_logger('asterisk_agent', level=config.LOG_LEVEL)
-
-def ami_events_publisher():
+# Switch to binary only when all agents and tools understand it
+ZmqMessage.wire_format = getattr(config, 'WIRE_FORMAT', 'json')
+# Every process keeps its own metrics and pushes them to the main process
+metrics = Metrics('zmq_ami_agent', logger)
+# Compress ESB messages of at least COMPRESS_THRESHOLD bytes, 0 - off.
+# Switch it on only when all agents and tools understand it.
+COMPRESS_THRESHOLD = getattr(config, 'COMPRESS_THRESHOLD', 0)
+if COMPRESS_THRESHOLD:
+    ZmqMessage.compressor = Compressor(COMPRESS_THRESHOLD,
+                                       getattr(config, 'COMPRESS_LEVEL', 6),
+                                       metrics)
+STATS_PORT = getattr(config, 'STATS_PORT', 0)
+# Agent processes push metrics to the main one, a socket per SYSTEM_NAME
+# so several agents can run on one host
+STATS_COLLECT_URL = getattr(config, 'STATS_COLLECT_URL', 'ipc://%s' % os.path.join(
+    tempfile.gettempdir(), 'zmq_agent_stats-%s.ipc' % urllib.quote(
+        config.SYSTEM_NAME, '')))
+RESYNC_RATE = getattr(config, 'RESYNC_RATE', 50)
+STATE_JOURNAL_DIR = getattr(config, 'STATE_JOURNAL_DIR', None)
+# Events sent by the agent to itself when Asterisk has lost Custom: states
+RESYNC_EVENTS = ('FullyBooted', 'AsteriskReconnected')
+# processes - a process per role, threads - all roles in one process
+AGENT_RUNTIME = getattr(config, 'AGENT_RUNTIME', 'processes')
+# Shared connections of threads runtime
+ESB_OUT_URL = 'inproc://esb-out'
+ASTERISK_POOL_URL = 'inproc://asterisk-cmd'
+# Where roles send ESB messages, threads runtime points it to the shared connection
+esb_pub_url = config.ZMQ_PUB_URL
+# Msec to collect device states into one ESB message, 0 - send every one at once
+EVENT_BATCH_INTERVAL = getattr(config, 'EVENT_BATCH_INTERVAL', 0)
+EVENT_BATCH_SIZE = getattr(config, 'EVENT_BATCH_SIZE', 100)
+# Seconds between heartbeats to ESB and Asterisk Pings, a link is down
+# after HEARTBEAT_TIMEOUT seconds without reply.
+HEARTBEAT_INTERVAL = getattr(config, 'HEARTBEAT_INTERVAL', 0.5)
+HEARTBEAT_TIMEOUT = getattr(config, 'HEARTBEAT_TIMEOUT', 2)
+# Hop timestamps in 1 of every TRACE_EVERY device state messages, 0 - off
+TRACE_EVERY = getattr(config, 'TRACE_EVERY', 100)
+# Per-message logs: 1 of every LOG_SAMPLE_EVERY, at most LOG_SAMPLE_RATE a second
+trace = LogSampler(logger, getattr(config, 'LOG_SAMPLE_EVERY', 1),
+                   getattr(config, 'LOG_SAMPLE_RATE', 100))
+
+
+def report_metrics(process):
+    # Threads runtime has one metrics object for all roles
+    if STATS_PORT and AGENT_RUNTIME == 'processes':
+        start_thread(push_metrics, metrics, STATS_COLLECT_URL, process)
+
+
+class EventBatcher(object):
+    """
+    Collects AMI events to send them to ESB as one AsteriskEventBatch
+    message when interval msec passed since the first one or there are
+    size events.
+    """
+    def __init__(self, socket, interval, size):
+        self.socket = socket
+        self.interval = interval / 1000.0
+        self.size = size
+        self.events = []
+        self.deadline = None
+        self.received = None # First event receive time
+        self.batches = 0
+
+    def add(self, event, received=None):
+        if not self.events:
+            self.deadline = time.time() + self.interval
+            self.received = received
+        self.events.append(event)
+        if len(self.events) >= self.size:
+            self.flush()
+
+    def timeout(self):
+        # Msec left to wait for more events
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+    def flush(self):
+        if not self.events:
+            return
+        batch = AsteriskEventBatch(origin=config.SYSTEM_NAME, events=self.events)
+        self.batches += 1
+        if TRACE_EVERY and self.received and self.batches % TRACE_EVERY == 0:
+            batch.x_trace = {'event': self.received}
+            trace_hop(metrics, batch.x_trace, 'publish')
+        self.socket.send_multipart(['[*]', batch.dump()])
+        metrics.inc('batches_published')
+        metrics.inc('events_batched', len(self.events))
+        self.events = []
+
+
+def ami_events_publisher(context=None):
     """
     The process connects to Asterisk ZMQ AMI events and sends
     some of them to ESB.
     """
     try:
         logger.info('Asterisk ZMQ pub started.')
-        context = zmq.Context()
+        report_metrics('publisher')
+        context = context or zmq.Context()
         # Connect to Asterisk events socket
         evt_socket = context.socket(zmq.SUB)
         #evt_socket.linger = 0
@@ -31,26 +124,62 @@ def ami_events_publisher():
         # Connect to ESB PUB scoket
         pub_socket = context.socket(zmq.PUSH)
         #pub_socket.linger = 0
-        pub_socket.connect(config.ZMQ_PUB_URL)
+        set_heartbeat(pub_socket, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+        pub_socket.connect(esb_pub_url)
+        # Cheap check of the raw event before json decoding
+        event_filter = EventFilter(getattr(config, 'EVENT_WHITELIST',
+                                           ['DeviceStateChange', 'Reload',
+                                            'FullyBooted']))
+        metrics.set('events_filter_accepted', lambda: event_filter.accepted)
+        metrics.set('events_filter_rejected', lambda: event_filter.rejected)
+        batcher = None
+        if EVENT_BATCH_INTERVAL:
+            batcher = EventBatcher(pub_socket, EVENT_BATCH_INTERVAL, EVENT_BATCH_SIZE)
+        device_events = 0
         while True:
-            msg = evt_socket.recv_json()
+            if batcher and batcher.events:
+                # Flush on time even if events keep coming
+                timeout = batcher.timeout()
+                if not timeout or not evt_socket.poll(timeout):
+                    batcher.flush()
+                    continue
+            data = evt_socket.recv()
+            if not event_filter.accept(data):
+                if event_filter.rejected % 10000 == 0:
+                    logger.info('Event filter: %s', event_filter)
+                continue
+            received = time.time()
+            msg = json.loads(data)
+            metrics.observe('json_decode', time.time() - received)
             event = msg.get('Event', None)
+            metrics.inc('events_received', event=event)
             # DeviceStateChange from Asterisk
             if event == 'DeviceStateChange':
                 if msg.get('State') == 'UNKNOWN':
                     # We do not replicate UNKNOWN states
                     continue
-                logger.debug('My device %s state %s.' % (msg.get('Device'),
-                                                      msg.get('State')))
-                zmq_msg = AsteriskEvent(origin=config.SYSTEM_NAME,
-                                        data={
-                                            'Event': 'DeviceStateChange',
-                                            'Device': msg.get('Device'),
-                                            'State': msg.get('State')
-                                        })
+                trace.debug('My device %s state %s.', msg.get('Device'),
+                            msg.get('State'))
+                metrics.inc('events_published', event=event)
+                if batcher:
+                    batcher.add({'Event': event, 'Device': msg.get('Device'),
+                                 'State': msg.get('State')}, received)
+                    continue
+                device_events += 1
+                hops = None
+                if TRACE_EVERY and device_events % TRACE_EVERY == 0:
+                    hops = {'event': received}
+                    trace_hop(metrics, hops, 'publish')
+                zmq_msg = AsteriskEvent.device_state(config.SYSTEM_NAME,
+                                                     msg.get('Device'),
+                                                     msg.get('State'), hops)
                 pub_socket.send_multipart(['[*]', zmq_msg.dump()])
+                continue
+            # Other events must not overtake batched ones
+            if batcher:
+                batcher.flush()
             # Reload event from Asterisk
-            elif event == 'Reload':
+            if event == 'Reload':
                 zmq_msg = AsteriskEvent(origin=config.SYSTEM_NAME,
                                         data={
                                             'Event': 'Reload',
@@ -59,6 +188,17 @@ def ami_events_publisher():
                                        })
                 # Send to all as we don't know who needs it.
                 pub_socket.send_multipart(['[*]', zmq_msg.dump()])
+                metrics.inc('events_published', event=event)
+            # Asterisk is (re)started, tell own subscriber to resync states
+            elif event == 'FullyBooted':
+                zmq_msg = AsteriskEvent(origin=config.SYSTEM_NAME,
+                                        data={
+                                            'Event': 'FullyBooted',
+                                            'Status': msg.get('Status'),
+                                        })
+                pub_socket.send_multipart(['[%s]' % config.SYSTEM_NAME,
+                                           zmq_msg.dump()])
+                metrics.inc('events_published', event=event)
 
             #else:
             #    print msg
@@ -69,78 +209,363 @@ def ami_events_publisher():
 
 
 # Asterisk commands
+class AsteriskConnection(object):
+    """
+    Long-lived DEALER connection to Asterisk commands socket.
+    Every thread gets its own socket which is kept between actions.
+    Several actions can be sent before waiting, replies are matched
+    by ActionID.
+    """
+    reconnect_after = 3 # Consecutive timeouts to drop the socket.
+
+    def __init__(self, url, timeout=5000):
+        self.url = url
+        self.timeout = timeout # Msec to wait for reply.
+        self.local = threading.local()
+
+    def _state(self):
+        # Sockets cannot be shared between threads and forked processes
+        state = self.local
+        if getattr(state, 'pid', None) != os.getpid():
+            state.pid = os.getpid()
+            state.socket = None
+            state.replies = {} # {ActionID: reply}
+            state.pending = set() # ActionIDs waiting for reply
+            state.timeouts = 0
+        if state.socket is None:
+            context = zmq.Context.instance()
+            state.socket = context.socket(zmq.DEALER)
+            state.socket.setsockopt(zmq.LINGER, 0)
+            state.socket.connect(self.url)
+            state.poll = zmq.Poller()
+            state.poll.register(state.socket, zmq.POLLIN)
+        return state
+
+    def close(self):
+        state = self.local
+        if getattr(state, 'socket', None) is not None:
+            state.poll.unregister(state.socket)
+            state.socket.close()
+            state.socket = None
+
+    def send(self, action):
+        """
+        Sends action without waiting, returns its ActionID.
+        """
+        state = self._state()
+        action_id = str(action.get('ActionID') or uuid.uuid4().hex)
+        action = dict(action, ActionID=action_id)
+        # Empty delimiter frame is expected by REP on Asterisk side
+        state.socket.send_multipart(['', json.dumps(action)])
+        state.pending.add(action_id)
+        return action_id
+
+    def wait(self, action_id, timeout=None):
+        """
+        Waits for the reply to action sent before, None on timeout.
+        """
+        state = self._state()
+        deadline = time.time() + (timeout or self.timeout) / 1000.0
+        try:
+            while action_id not in state.replies:
+                left = int((deadline - time.time()) * 1000)
+                if left <= 0 or not state.poll.poll(left):
+                    self._timeout(state)
+                    return None
+                while True:
+                    try:
+                        data = state.socket.recv_multipart(zmq.NOBLOCK)[-1]
+                    except zmq.Again:
+                        break
+                    self._store_reply(state, data)
+            state.timeouts = 0
+            return state.replies.pop(action_id)
+        finally:
+            state.pending.discard(action_id)
+
+    def action(self, action, timeout=None):
+        return self.wait(self.send(action), timeout)
+
+    def _store_reply(self, state, data):
+        reply = json.loads(data)
+        # Asterisk replies with a list of AMI messages
+        first = reply[0] if isinstance(reply, list) and reply else reply
+        action_id = first.get('ActionID') if isinstance(first, dict) else None
+        if action_id is None and len(state.pending) == 1:
+            # Reply without ActionID can only be for the one we wait
+            action_id = next(iter(state.pending))
+        if action_id in state.pending:
+            state.replies[action_id] = reply
+        else:
+            logger.debug('Dropping late Asterisk reply: %s', data)
+
+    def _timeout(self, state):
+        # DEALER is not locked by missing reply so keep the socket unless
+        # Asterisk looks gone for good.
+        state.timeouts += 1
+        if state.timeouts >= self.reconnect_after:
+            logger.warning('No reply from Asterisk %s times, reconnecting.' %
+                           state.timeouts)
+            self.close()
+            state.timeouts = 0
+
+
+asterisk = AsteriskConnection(config.ASTERISK_CMD_URL)
+
+
 def asterisk_action(action):
     """
     :param action: {'Action': 'Name', ...}
     :return: reply from Asterisk
     """
-    logger.debug('Sending action %s to %s' % (action.get('Action'),
-                                              config.ASTERISK_CMD_URL))
-    # Asterisk CMD socket
-    context = zmq.Context.instance()
-    sock = context.socket(zmq.REQ)
-    sock.setsockopt(zmq.LINGER, 0)
-    sock.connect(config.ASTERISK_CMD_URL)
-    poll = zmq.Poller()
+    # Action and its reply are logged together or not at all
+    traced = trace.sample(logging.DEBUG)
+    if traced:
+        logger.debug('Sending action %s to %s', action.get('Action'),
+                     config.ASTERISK_CMD_URL)
+    name = action.get('Action')
+    metrics.inc('actions_sent', action=name)
     try:
-        poll.register(sock, zmq.POLLIN)
-        sock.send(json.dumps(action))
-        socks = dict(poll.poll(5000)) # 5 seconds to reply!
-        if socks.get(sock) == zmq.POLLIN:
-            reply = sock.recv_json()
-            logger.debug('Asterisk reply: %s' % json.dumps(reply, indent=2,
-                                                           sort_keys=True))
+        start = time.time()
+        reply = asterisk.action(action)
+        if reply is not None:
+            metrics.inc('replies', action=name)
+            metrics.observe('action_rtt', time.time() - start, action=name)
+            if traced:
+                logger.debug('Asterisk reply: %s', Lazy(json.dumps, reply,
+                                                        indent=2, sort_keys=True))
             return reply
         else:
-            logger.error('Asterisk did not reply! Action: %s' % json.dumps(
-                                            action, indent=2, sort_keys=True))
+            metrics.inc('timeouts', action=name)
+            logger.error('Asterisk did not reply! Action: %s', Lazy(
+                json.dumps, action, indent=2, sort_keys=True))
 
     except zmq.ZMQError, e:
         logger.error('Asterisk command ZMQError: %s' % e)
+        asterisk.close()
 
+    except ValueError:
+        logger.error('Unexpected Asterisk reply to %s' % action.get('Action'))
+
+
+class ActionWorkers(object):
+    """
+    Runs Asterisk actions in worker threads so that a slow Asterisk
+    does not stall the subscriber loop. Jobs with the same key (e.g. device)
+    always go to the same worker to keep their order.
+    """
+    def __init__(self, workers=4, queue_size=1000, overflow='drop_oldest'):
+        if overflow not in ('drop_oldest', 'drop_newest', 'block'):
+            raise Exception('Unknown ACTION_OVERFLOW %s' % overflow)
+        self.overflow = overflow
+        self.queues = [Queue.Queue(queue_size) for i in range(workers)]
+        self.submitted = 0
+        self.done = 0
+        self.dropped = 0
+        self.local = threading.local()
+        for queue in self.queues:
+            thread = threading.Thread(target=self._work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, func, *args):
+        queue = self.queues[hash(key) % len(self.queues)]
+        self.submitted += 1
+        if self.overflow == 'block':
+            # Backpressure goes to ESB socket buffers
+            queue.put((func, args))
+            return True
+        while True:
+            try:
+                queue.put_nowait((func, args))
+                return True
+            except Queue.Full:
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    logger.warning('Action queue is full: %s' % self)
+                if self.overflow == 'drop_newest':
+                    return False
+                # Newer state is worth more than the oldest one
+                try:
+                    queue.get_nowait()
+                    queue.task_done()
+                except Queue.Empty:
+                    pass
+
+    def pub_socket(self):
+        # Every worker thread needs its own socket to ESB
+        sock = getattr(self.local, 'pub_socket', None)
+        if sock is None:
+            sock = zmq.Context.instance().socket(zmq.PUSH)
+            sock.setsockopt(zmq.TCP_KEEPALIVE, 1)
+            set_heartbeat(sock, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+            sock.connect(esb_pub_url)
+            self.local.pub_socket = sock
+        return sock
+
+    def _work(self, queue):
+        while True:
+            func, args = queue.get()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Action worker error')
+            finally:
+                self.done += 1
+                queue.task_done()
+
+    def depth(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def __str__(self):
+        return 'submitted %s, done %s, dropped %s, queued %s' % (
+            self.submitted, self.done, self.dropped, self.depth())
+
+
+def set_device_state(action_id, device, state, hops=None):
+    action = {
+        'Action': 'SetVar',
+        'ActionID': action_id,
+        'Variable': 'DEVICE_STATE(Custom:%s)' % device,
+        'Value': '%s' % state,
+    }
+    asterisk_action(action)
+    if hops:
+        # Queue wait and SetVar, then from the event on the other Asterisk
+        trace_hop(metrics, hops, 'reply')
+        if 'event' in hops:
+            metrics.observe('trace_hop', max(0, hops['reply'] - hops['event']),
+                            hop='total')
+    trace.info('Other device: %s - %s', device, state)
+
+
+def resync_states(workers, states, lock):
+    """
+    Sets all known states of other agents' devices on Asterisk that
+    has lost them, at RESYNC_RATE actions per second.
+    """
+    try:
+        devices = states.keys()
+        logger.info('Resync of %s device states.' % len(devices))
+        limiter = RateLimiter(RESYNC_RATE)
+        for device in devices:
+            limiter.wait()
+            metrics.inc('resync_actions')
+            # Same worker as live changes so a newer state is not overwritten
+            workers.submit(device, set_device_state, new_uuid(), device,
+                           states[device])
+        logger.info('Resync is done.')
     finally:
-        poll.unregister(sock)
-        sock.close()
+        lock.release()
 
 
+def run_asterisk_action(workers, action):
+    status = asterisk_action(action.x_data)
+    if trace.sample():
+        logger.info('AsteriskAction: %s', action.x_data)
+        logger.info('AsteriskActionStatus: %s', status)
+    status_msg = AsteriskActionStatus(origin=config.SYSTEM_NAME,
+                                      data=status)
+    workers.pub_socket().send_multipart(['[%s]' % str(action.origin),
+                                         status_msg.dump()])
 
 
-def subscriber():
+def subscriber(context=None):
     """
     This process listens and handles ESB events.
     """
     try:
         logger.info('Subscriber started.')
-        context = zmq.Context()
+        report_metrics('subscriber')
+        context = context or zmq.Context()
         # Subscriber socket
         sub_socket = context.socket(zmq.SUB)
         #sub_socket.linger = 0
         sub_socket.setsockopt(zmq.SUBSCRIBE, '[*]')
         sub_socket.setsockopt(zmq.SUBSCRIBE, '[%s]' % config.SYSTEM_NAME)
+        set_heartbeat(sub_socket, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
         sub_socket.connect(config.ZMQ_SUB_URL)
         pub_socket = context.socket(zmq.PUSH)
         pub_socket.setsockopt(zmq.TCP_KEEPALIVE,1)
+        set_heartbeat(pub_socket, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
         #pub_socket.linger = 0
-        pub_socket.connect(config.ZMQ_PUB_URL)
+        pub_socket.connect(esb_pub_url)
+        # Asterisk actions are run by workers
+        workers = ActionWorkers(
+            workers=getattr(config, 'ACTION_WORKERS', 4),
+            queue_size=getattr(config, 'ACTION_QUEUE_SIZE', 1000),
+            overflow=getattr(config, 'ACTION_OVERFLOW', 'drop_oldest'))
+        metrics.set('action_queue_depth', workers.depth)
+        metrics.set('actions_submitted', lambda: workers.submitted)
+        metrics.set('actions_done', lambda: workers.done)
+        metrics.set('actions_dropped', lambda: workers.dropped)
+
+        # Files are written as chunks come
+        file_receiver = FileReceiver()
+        file_folders = [os.path.realpath(f) for f in
+                        getattr(config, 'FILE_FOLDERS', ['/etc/asterisk'])]
+
+        # Current states of other agents' devices {device: state}
+        states = {}
+        journal = None
+        if STATE_JOURNAL_DIR:
+            journal = StateJournal(STATE_JOURNAL_DIR)
+            states = journal.load()
+            logger.info('Loaded %s device states from %s' % (len(states),
+                                                             STATE_JOURNAL_DIR))
+        metrics.set('states', lambda: len(states))
+        resync_lock = threading.Lock()
+
+        def device_state_changed(action_id, data, hops=None):
+            event, device, state = data.get('Event'), data.get('Device'), data.get('State')
+            if event == 'DeviceStateChange' and not device.startswith('Custom:'):
+                if states.get(device) != state:
+                    states[device] = state
+                    if journal:
+                        journal.append(device, state)
+                workers.submit(device, set_device_state, action_id, device, state,
+                               hops)
 
         # Process messages
         msg_counter = 0
         while True:
-            target, msg = sub_socket.recv_multipart()
+            frames = sub_socket.recv_multipart()
+            received = time.time()
+            target, msg = frames[0], frames[1]
             msg_counter += 1
             # Log every 100 message count
             if msg_counter % 100 == 0:
-                logger.info('Message counter: %s' % msg_counter)
-            json_msg = json.loads(msg)
+                logger.info('Message counter: %s, actions: %s', msg_counter,
+                            workers)
+                file_receiver.expire()
+            decode_start = time.time()
+            try:
+                json_msg = decode_message(msg)
+            except ValueError, e:
+                # Newer version or a format we lack (e.g. msgpack), skip it
+                metrics.inc('decode_errors')
+                trace.error('Cannot decode message to %s: %s', target, e)
+                continue
+            metrics.observe('message_decode', time.time() - decode_start)
             msg_type = json_msg.get('msg_type')
-            logger.debug('Subscriber message: %s' % json.dumps(json_msg,
-                                                               indent=2,
-                                                               sort_keys=True))
+            metrics.inc('messages_received', msg_type=msg_type)
+            trace.debug('Subscriber message: %s', Lazy(json.dumps, json_msg,
+                                                       indent=2, sort_keys=True))
 
             if json_msg.get('origin') == config.SYSTEM_NAME:
-                logger.debug('Ignoring as coming from myself...')
+                if msg_type == 'AsteriskEvent' and RESYNC_RATE and \
+                        json_msg.get('x_data', {}).get('Event') in RESYNC_EVENTS:
+                    # One resync at a time, it sends the latest states anyway
+                    if resync_lock.acquire(False):
+                        start_thread(resync_states, workers, states, resync_lock)
+                    continue
+                trace.debug('Ignoring as coming from myself...')
                 continue
 
+            hops = json_msg.get('x_trace')
+            if hops:
+                trace_hop(metrics, hops, 'receive', received)
+
             # AgentPing
             if msg_type == 'AgentPing':
                 origin = str(json_msg.get('origin'))
@@ -150,86 +575,191 @@ def subscriber():
 
             # DeviceStateChange
             elif msg_type == 'AsteriskEvent':
-                data = json_msg.get('x_data', {})
-                event, device, state = data.get('Event'), data.get('Device'), data.get('State')
-                if event == 'DeviceStateChange' and not device.startswith('Custom:'):
-                    action = {
-                        'Action': 'SetVar',
-                        'ActionID': json_msg.get('uuid'),
-                        'Variable': 'DEVICE_STATE(Custom:%s)' % device,
-                        'Value': '%s' % state,
-                    }
-                    asterisk_action(action)
-                    logger.info('Other device: %s - %s' % (device, state))
+                device_state_changed(json_msg.get('uuid'), json_msg.get('x_data', {}),
+                                     hops)
+
+            # Events are applied in order, one device always goes to one worker
+            elif msg_type == 'AsteriskEventBatch':
+                for i, data in enumerate(json_msg.get('x_events') or []):
+                    # Trace is for the first event of the batch
+                    device_state_changed('%s-%s' % (json_msg.get('uuid'), i), data,
+                                         hops if i == 0 else None)
 
 
             # AsteriskAction
             elif msg_type == 'AsteriskAction':
                 action = AsteriskAction(message=msg)
-                status = asterisk_action(action.x_data)
-                logger.info('AsteriskAction: %s' % action.x_data)
-                status_msg = AsteriskActionStatus(origin=config.SYSTEM_NAME,
-                                              data=status)
-                logger.info('AsteriskActionStatus: %s' % status)
-                pub_socket.send_multipart(['[%s]' % str(action.origin), status_msg.dump()])
+                workers.submit(action.origin, run_asterisk_action, workers, action)
+
+            # File chunk, raw data is in the next frame
+            elif msg_type == 'FileChunk':
+                chunk = FileChunk(message=msg)
+                folder = os.path.realpath(chunk.x_folder)
+                if not chunk.x_file_name or chunk.x_file_name in ('.', '..') or \
+                        os.path.basename(chunk.x_file_name) != chunk.x_file_name or \
+                        not any(folder == f or folder.startswith(f + os.sep)
+                                for f in file_folders):
+                    logger.error('File %s to %s is not allowed by FILE_FOLDERS' % (
+                        chunk.x_file_name, chunk.x_folder))
+                    status = {'x_offset': 0, 'x_status': 'error'}
+                else:
+                    try:
+                        status = file_receiver.handle(chunk, frames[2] if len(frames) > 2 else '')
+                    except (IOError, OSError), e:
+                        # Read-only folder, full disk and so on
+                        logger.error('File %s to %s: %s' % (chunk.x_file_name,
+                                                            chunk.x_folder, e))
+                        file_receiver.abort(chunk.x_transfer)
+                        status = {'x_offset': 0, 'x_status': 'error'}
+                if status:
+                    status_msg = FileStatus(origin=config.SYSTEM_NAME)
+                    status_msg.x_transfer = chunk.x_transfer
+                    status_msg.x_file_name = chunk.x_file_name
+                    status_msg.x_offset = status['x_offset']
+                    status_msg.x_status = status['x_status']
+                    logger.info('File %s from %s: %s at %s' % (
+                        chunk.x_file_name, chunk.origin, status_msg.x_status,
+                        status_msg.x_offset))
+                    pub_socket.send_multipart(['[%s]' % str(chunk.origin),
+                                               status_msg.dump()])
 
 
     except KeyboardInterrupt:
         logger.info('Subscriber: exit.')
         sub_socket.close()
+        if journal:
+            journal.close()
 
 
-def keep_alive():
-    try:
-        logger.info('Ping starter at interval %s' % config.KEEP_ALIVE_INTERVAL)
-        context = zmq.Context.instance()
-        pub_socket = context.socket(zmq.PUSH)
-        # pub_socket.linger  = 0
-        pub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
-        pub_socket.connect(config.ZMQ_PUB_URL)
-        while True:
-            # Ping Asterisk
-            ping = {
-                'Action': 'Ping'
-            }
-            reply = asterisk_action(ping)
-            if reply and reply[0].get('Response'):
+def asterisk_pinger(context, link):
+    """
+    Pings Asterisk every HEARTBEAT_INTERVAL and sends Ping status to
+    AsteriskStats every KEEP_ALIVE_INTERVAL. When Asterisk replies again
+    after it was lost, an AsteriskReconnected event is sent to the agent.
+    """
+    pub_socket = context.socket(zmq.PUSH)
+    pub_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+    set_heartbeat(pub_socket, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+    pub_socket.connect(esb_pub_url)
+    last_stats = 0
+    while True:
+        start = time.time()
+        try:
+            reply = asterisk.action({'Action': 'Ping'},
+                                    timeout=HEARTBEAT_TIMEOUT * 1000)
+        except (zmq.ZMQError, ValueError), e:
+            logger.error('Asterisk Ping error: %s', e)
+            asterisk.close()
+            reply = None
+        now = time.time()
+        if reply and reply[0].get('Response'):
+            metrics.observe('asterisk_rtt', now - start)
+            if link.reply(now - start, now):
+                # States set while Asterisk was away are lost
+                logger.info('Asterisk is back.')
+                event = AsteriskEvent(origin=config.SYSTEM_NAME,
+                                      data={'Event': 'AsteriskReconnected'})
+                pub_socket.send_multipart(['[%s]' % config.SYSTEM_NAME,
+                                           event.dump()])
+            if now - last_stats >= config.KEEP_ALIVE_INTERVAL:
                 status_msg = AsteriskActionStatus(origin=config.SYSTEM_NAME, data={
                     'Action': 'Ping',
                     'Response': reply[0].get('Response'),
                     'Timestamp': reply[0].get('Timestamp'),
                 })
                 pub_socket.send_multipart(['[AsteriskStats]', status_msg.dump()])
-            else:
-                logger.error('asterisk_ping unknown reply: %s' % reply)
+                last_stats = now
+        elif link.check(now):
+            logger.error('No Ping reply from Asterisk for %s sec: %s',
+                         HEARTBEAT_TIMEOUT, reply)
+        time.sleep(max(0, start + HEARTBEAT_INTERVAL - time.time()))
 
-            # Ping Subscriber for keep-alive
-            ping = AgentPing(origin='%s' % config.SYSTEM_NAME)
-            pub_socket.send_multipart(['[%s]' % str(config.SYSTEM_NAME),
-                                       ping.dump()])
-            logger.debug('AsteriskPing is sent.')
 
-            time.sleep(config.KEEP_ALIVE_INTERVAL)
+def liveness(context=None):
+    """
+    Sends a heartbeat to all agents through ESB every HEARTBEAT_INTERVAL.
+    Own heartbeat coming back is the ESB round trip, heartbeats of other
+    agents make the peer table. Asterisk is pinged in a thread.
+    """
+    try:
+        logger.info('Liveness started, heartbeat every %s sec.',
+                    HEARTBEAT_INTERVAL)
+        report_metrics('liveness')
+        context = context or zmq.Context.instance()
+        # Own connection even in threads runtime: heartbeats are dropped
+        # while ESB is away, not queued to come back late.
+        pub_socket = context.socket(zmq.PUSH)
+        pub_socket.setsockopt(zmq.IMMEDIATE, 1)
+        pub_socket.setsockopt(zmq.SNDHWM, 10)
+        pub_socket.setsockopt(zmq.LINGER, 0)
+        set_heartbeat(pub_socket, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+        pub_socket.connect(config.ZMQ_PUB_URL)
+        sub_socket = context.socket(zmq.SUB)
+        sub_socket.setsockopt(zmq.SUBSCRIBE, HEARTBEAT_TOPIC)
+        set_heartbeat(sub_socket, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+        sub_socket.connect(config.ZMQ_SUB_URL)
+        esb = LinkStats(HEARTBEAT_TIMEOUT)
+        asterisk_link = LinkStats(HEARTBEAT_TIMEOUT)
+        peers = PeerTable(metrics)
+        metrics.set('esb_alive', lambda: int(bool(esb.alive)))
+        metrics.set('esb_failures', lambda: esb.failures)
+        metrics.set('asterisk_alive', lambda: int(bool(asterisk_link.alive)))
+        metrics.set('asterisk_failures', lambda: asterisk_link.failures)
+        start_thread(asterisk_pinger, context, asterisk_link)
+        seq, next_beat = 0, time.time()
+        while True:
+            now = time.time()
+            if now >= next_beat:
+                seq += 1
+                heartbeat = AgentHeartbeat(
+                    origin=config.SYSTEM_NAME, seq=seq, sent=now,
+                    timeout=HEARTBEAT_TIMEOUT, esb_rtt=esb.percentile(50),
+                    asterisk_rtt=asterisk_link.percentile(50))
+                try:
+                    pub_socket.send_multipart([HEARTBEAT_TOPIC, heartbeat.dump()],
+                                              zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+                next_beat = now + HEARTBEAT_INTERVAL
+                if esb.check(now):
+                    logger.error('No heartbeat back from ESB for %s sec.',
+                                 HEARTBEAT_TIMEOUT)
+                for name in peers.check(now):
+                    logger.warning('Agent %s is down.', name)
+            if not sub_socket.poll(max(0, int((next_beat - time.time()) * 1000))):
+                continue
+            try:
+                heartbeat = load_message(sub_socket.recv_multipart()[1])
+            except ValueError, e:
+                metrics.inc('decode_errors')
+                trace.error('Cannot decode heartbeat: %s', e)
+                continue
+            now = time.time()
+            if heartbeat.origin == config.SYSTEM_NAME:
+                metrics.observe('esb_rtt', now - heartbeat.x_sent)
+                if esb.reply(now - heartbeat.x_sent, now):
+                    logger.info('ESB is back.')
+            elif peers.update(heartbeat, now):
+                logger.info('Agent %s is up.', heartbeat.origin)
 
     except KeyboardInterrupt:
-        logger.info('Ping: exit.')
+        logger.info('Liveness: exit.')
         pub_socket.close()
+        sub_socket.close()
 
 
-
-if __name__ == '__main__':
-    pid = str(os.getpid())
-    pidfile = os.path.join(os.path.dirname(__file__), 'zmq_agent.pid')
-    if os.path.isfile(pidfile):
-        print "%s already exists, exiting." % pidfile
-        sys.exit()
-    open(pidfile, 'w').write(pid)
+def run_processes():
+    if STATS_PORT:
+        collector = MetricsCollector(metrics, STATS_COLLECT_URL)
+        start_thread(collector.run)
+        serve_metrics(collector.render, STATS_PORT,
+                      getattr(config, 'STATS_ADDR', '127.0.0.1'))
     try:
         p1 = Process(target=ami_events_publisher)
         p1.start()
         p2 = Process(target=subscriber)
         p2.start()
-        p3 = Process(target=keep_alive)
+        p3 = Process(target=liveness)
         p3.start()
         # Wait for all
         p1.join()
@@ -241,5 +771,62 @@ if __name__ == '__main__':
         p3.terminate()
         logger.info('Main: exit.')
     finally:
-        os.unlink(pidfile)
+        path = STATS_COLLECT_URL[len('ipc://'):]
+        if STATS_PORT and STATS_COLLECT_URL.startswith('ipc://') and \
+                os.path.exists(path):
+            os.unlink(path)
 
+
+def run_threads():
+    """
+    Runs all roles as threads of one process sharing ZMQ context,
+    one ESB connection and one Asterisk commands connection.
+    """
+    global esb_pub_url
+    context = zmq.Context.instance()
+    # Threads push to inproc, one socket sends it all to ESB
+    esb_in = context.socket(zmq.PULL)
+    esb_in.bind(ESB_OUT_URL)
+    esb_out = context.socket(zmq.PUSH)
+    esb_out.setsockopt(zmq.TCP_KEEPALIVE, 1)
+    set_heartbeat(esb_out, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+    esb_out.connect(config.ZMQ_PUB_URL)
+    start_thread(zmq.proxy, esb_in, esb_out)
+    esb_pub_url = ESB_OUT_URL
+    # Thread DEALER sockets go to ROUTER which keeps their identity in the
+    # envelope, so Asterisk REP replies find their way back.
+    cmd_in = context.socket(zmq.ROUTER)
+    cmd_in.bind(ASTERISK_POOL_URL)
+    cmd_out = context.socket(zmq.DEALER)
+    cmd_out.setsockopt(zmq.LINGER, 0)
+    cmd_out.connect(config.ASTERISK_CMD_URL)
+    start_thread(zmq.proxy, cmd_in, cmd_out)
+    asterisk.url = ASTERISK_POOL_URL
+    if STATS_PORT:
+        serve_metrics(metrics.render, STATS_PORT,
+                      getattr(config, 'STATS_ADDR', '127.0.0.1'))
+    for role in (ami_events_publisher, subscriber, liveness):
+        start_thread(role, context)
+    try:
+        # Only main thread gets KeyboardInterrupt
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info('Main: exit.')
+
+
+if __name__ == '__main__':
+    pid = str(os.getpid())
+    pidfile = getattr(config, 'PID_FILE', os.path.join(
+                      os.path.dirname(__file__), 'zmq_agent.pid'))
+    if os.path.isfile(pidfile):
+        print "%s already exists, exiting." % pidfile
+        sys.exit()
+    open(pidfile, 'w').write(pid)
+    try:
+        if AGENT_RUNTIME == 'threads':
+            run_threads()
+        else:
+            run_processes()
+    finally:
+        os.unlink(pidfile)
@@ -6,3 +6,44 @@ KEEP_ALIVE_INTERVAL = 30
 ZMQ_PUB_URL = 'tcp://127.0.0.1:55556'
 ZMQ_SUB_URL = 'tcp://127.0.0.1:55555'
 
+# AMI events sent to ESB, others are dropped before json decoding.
+EVENT_WHITELIST = ['DeviceStateChange', 'Reload', 'FullyBooted']
+# Threads running Asterisk actions received from ESB.
+ACTION_WORKERS = 4
+ACTION_QUEUE_SIZE = 1000
+# drop_oldest, drop_newest or block when action queue is full.
+ACTION_OVERFLOW = 'drop_oldest'
+# ESB message format: json, binary (compact header, json body) or
+# msgpack (compact header, msgpack body). Agents read all of them.
+WIRE_FORMAT = 'json'
+# Folders files can be pushed to with push_file.py.
+FILE_FOLDERS = ['/etc/asterisk']
+# Prometheus metrics on http://127.0.0.1:STATS_PORT/metrics, 0 - off.
+STATS_PORT = 0
+# Actions per second to set other agents' device states on Asterisk
+# after restart or reconnect, 0 - no resync.
+RESYNC_RATE = 50
+# Folder to keep other agents' device states between restarts, None - off.
+STATE_JOURNAL_DIR = None
+# processes - publisher, subscriber and liveness run as processes,
+# threads - in one process sharing ZMQ context and connections.
+AGENT_RUNTIME = 'processes'
+# Msec to collect own device states into one ESB message, 0 - send every
+# state at once. Batch is sent earlier when it has EVENT_BATCH_SIZE states.
+EVENT_BATCH_INTERVAL = 0
+EVENT_BATCH_SIZE = 100
+# Per-message logs: 1 of every LOG_SAMPLE_EVERY records, at most
+# LOG_SAMPLE_RATE a second, 0 - no limit.
+LOG_SAMPLE_EVERY = 1
+LOG_SAMPLE_RATE = 100
+# Seconds between heartbeats through ESB and Asterisk Pings, a link or
+# a peer agent is down after HEARTBEAT_TIMEOUT seconds without reply.
+HEARTBEAT_INTERVAL = 0.5
+HEARTBEAT_TIMEOUT = 2
+# Hop timestamps in 1 of every TRACE_EVERY device state messages for
+# trace_hop_seconds metrics, 0 - off.
+TRACE_EVERY = 100
+# Compress ESB messages of at least that many bytes with zlib, 0 - off.
+# Agents read compressed messages since this version, upgrade all first.
+COMPRESS_THRESHOLD = 0
+COMPRESS_LEVEL = 6
@@ -0,0 +1,173 @@
+#!/usr/bin/env python2.7
+"""
+Records AMI events of a res_zmq_manager evt socket to a file and replays
+them on a fake server (see fake_manager.py) to load test the Broker and
+the Agent / Server chain with real traffic.
+
+    python ami_capture.py record tcp://192.168.56.101:30968 monday.cap
+    python ami_capture.py replay monday.cap --speed 10
+    python ami_capture.py replay monday.cap --speed 0 --evt-port 30968
+
+Capture file is a header followed by records of a timestamp (double),
+frame length (unsigned int) in network byte order and the raw frame.
+Records are only appended, a file can be recorded in several runs.
+"""
+
+__author__ = 'litnimax@asteriskguru.ru'
+
+import argparse
+import struct
+import sys
+import time
+
+import zmq
+
+from fake_manager import FakeManager
+
+MAGIC = 'AMICAP1\n'
+RECORD = struct.Struct('!dI')
+
+
+class CaptureWriter(object):
+    """
+    Appends frames with their receive time to a capture file.
+    """
+    def __init__(self, filename):
+        self.file = open(filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.count = 0
+
+    def write(self, frame, timestamp=None):
+        self.file.write(RECORD.pack(timestamp or time.time(), len(frame)))
+        self.file.write(frame)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(filename):
+    """
+    Yields (timestamp, frame) of a capture file. A record cut by killed
+    recorder at the end of file is skipped.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not an AMI capture' % filename)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, length = RECORD.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield timestamp, frame
+
+
+def replay(frames, publish, speed=1.0):
+    """
+    Calls publish(frame) for every (timestamp, frame) keeping the pace of
+    the capture speed times faster, speed 0 - as fast as possible.
+    Returns the number of frames and seconds spent.
+    """
+    count, start, first = 0, time.time(), None
+    for timestamp, frame in frames:
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = start + (timestamp - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        publish(frame)
+        count += 1
+    return count, time.time() - start
+
+
+def record(args):
+    context = zmq.Context.instance()
+    sock = context.socket(zmq.SUB)
+    # Storms are what we are after, keep every frame
+    sock.setsockopt(zmq.RCVHWM, 0)
+    sock.setsockopt(zmq.SUBSCRIBE, '')
+    sock.connect(args.url)
+    writer = CaptureWriter(args.file)
+    deadline = args.duration and time.time() + args.duration
+    flushed = time.time()
+    print >> sys.stderr, 'Recording %s to %s, Ctrl+C to stop.' % (args.url,
+                                                                   args.file)
+    try:
+        while not (args.count and writer.count >= args.count):
+            timeout = 1000
+            if deadline:
+                timeout = int((deadline - time.time()) * 1000)
+                if timeout <= 0:
+                    break
+            if sock.poll(min(timeout, 1000)):
+                writer.write(sock.recv())
+            if time.time() - flushed >= 1:
+                writer.flush()
+                flushed = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        sock.close()
+    print >> sys.stderr, 'Recorded %s events.' % writer.count
+
+
+def replay_capture(args):
+    manager = FakeManager(evt_url='tcp://%s:%s' % (args.addr, args.evt_port),
+                          cmd_url='tcp://%s:%s' % (args.addr, args.cmd_port))
+    manager.latency = args.latency
+    manager.record = False
+    # Replay at max speed must not lose events
+    manager.evt_hwm = 0
+    manager.start()
+    try:
+        # Let the Broker or the Agent connect
+        time.sleep(args.wait)
+        for i in range(args.loop):
+            count, elapsed = replay(read_capture(args.file),
+                                    manager.publish_raw, args.speed)
+            print >> sys.stderr, 'Replayed %s events in %.1f sec, %.1f events/s.' % (
+                count, elapsed, count / max(elapsed, 0.001))
+        # Queued events are still being sent
+        time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        manager.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record and replay AMI events.')
+    commands = parser.add_subparsers()
+    parser_record = commands.add_parser('record', help='record AMI events')
+    parser_record.add_argument('url', help='res_zmq_manager evt socket')
+    parser_record.add_argument('file')
+    parser_record.add_argument('--duration', type=float, default=0,
+                               help='seconds, 0 - until Ctrl+C')
+    parser_record.add_argument('--count', type=int, default=0,
+                               help='events, 0 - until Ctrl+C')
+    parser_record.set_defaults(func=record)
+    parser_replay = commands.add_parser('replay', help='replay AMI events')
+    parser_replay.add_argument('file')
+    parser_replay.add_argument('--speed', type=float, default=1.0,
+                               help='times faster than recorded, 0 - max speed')
+    parser_replay.add_argument('--loop', type=int, default=1,
+                               help='times to replay the capture')
+    parser_replay.add_argument('--addr', default='127.0.0.1')
+    parser_replay.add_argument('--cmd-port', type=int, default=30967)
+    parser_replay.add_argument('--evt-port', type=int, default=30968)
+    parser_replay.add_argument('--latency', type=int, default=0,
+                               help='reply latency, msec')
+    parser_replay.add_argument('--wait', type=float, default=1.0,
+                               help='seconds for subscribers to connect')
+    parser_replay.set_defaults(func=replay_capture)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python2.7
+"""
+Microbenchmarks of ZmqMessage: encode / decode time and size of wire
+formats, construction time and memory per message class.
+
+    python bench_messages.py
+    python bench_messages.py --number 100000
+"""
+
+__author__ = 'litnimax@asteriskguru.ru'
+
+import argparse
+import gc
+import timeit
+
+from util import *
+
+
+def sample_messages():
+    return [
+        ('DeviceStateChange', AsteriskEvent(origin='Moscow', data={
+            'Event': 'DeviceStateChange',
+            'Device': 'SIP/100',
+            'State': 'NOT_INUSE'})),
+        ('AgentPing', AgentPing(origin='Moscow')),
+        ('AsteriskActionStatus', AsteriskActionStatus(origin='Moscow', data={
+            'Action': 'Ping',
+            'Response': 'Success',
+            'Timestamp': '1427887232.481723'})),
+    ]
+
+
+def bench_formats(number):
+    print '%-22s %-13s %6s %12s %12s' % ('message', 'format', 'bytes',
+                                         'encode, us', 'decode, us')
+    compressor = Compressor(threshold=0)
+    for name, msg in sample_messages():
+        for wire_format in WIRE_FORMATS:
+            if wire_format == 'msgpack' and msgpack is None:
+                continue
+            data = msg.dump(wire_format)
+            # Not msg.dump() as it returns cached bytes of immutable messages
+            encode = timeit.timeit(lambda: encode_message(msg.json(), wire_format),
+                                   number=number)
+            decode = timeit.timeit(lambda: load_message(data), number=number)
+            print '%-22s %-13s %6s %12.2f %12.2f' % (
+                name, wire_format, len(data),
+                encode / number * 1e6, decode / number * 1e6)
+            # Same with COMPRESS_THRESHOLD, preset dictionary
+            data = compressor.compress(data)
+            encode = timeit.timeit(lambda: compressor.compress(
+                encode_message(msg.json(), wire_format)), number=number)
+            decode = timeit.timeit(lambda: load_message(data), number=number)
+            print '%-22s %-13s %6s %12.2f %12.2f' % (
+                name, wire_format + '+zlib', len(data),
+                encode / number * 1e6, decode / number * 1e6)
+
+
+def rss_kb():
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1])
+
+
+def bench_classes(number):
+    constructors = [
+        ('AsteriskEvent()', lambda: AsteriskEvent(origin='Moscow', data={
+            'Event': 'DeviceStateChange', 'Device': 'SIP/100',
+            'State': 'INUSE'})),
+        ('AsteriskEvent.device_state', lambda: AsteriskEvent.device_state(
+            'Moscow', 'SIP/100', 'INUSE')),
+        ('AgentPing()', lambda: AgentPing(origin='Moscow')),
+        ('AsteriskActionStatus()', lambda: AsteriskActionStatus(
+            origin='Moscow', data={'Response': 'Success'})),
+    ]
+    print
+    print '%-28s %14s %14s %12s' % ('constructor', 'create, us',
+                                    'create+dump, us', 'bytes/msg')
+    for name, constructor in constructors:
+        create = timeit.timeit(constructor, number=number)
+        create_dump = timeit.timeit(lambda: constructor().dump(), number=number)
+        gc.collect()
+        before = rss_kb()
+        keep = [constructor() for i in xrange(number)]
+        memory = (rss_kb() - before) * 1024.0 / number
+        del keep
+        print '%-28s %14.2f %14.2f %12.0f' % (name, create / number * 1e6,
+                                              create_dump / number * 1e6, memory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ZmqMessage microbenchmarks.')
+    parser.add_argument('--number', type=int, default=20000,
+                        help='iterations per measurement')
+    args = parser.parse_args()
+    bench_formats(args.number)
+    bench_classes(args.number)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python2.7
+"""
+End-to-end benchmark on fake res_zmq_manager servers (see fake_manager.py).
+
+Generates DeviceStateChange / PresenceStateChange events on every fake server
+at the given rate and measures how fast they come back as SetVar actions on
+the other servers.
+
+Broker topology (broker.py connects to all fake servers):
+    python benchmark.py broker --servers 3 --rate 500 --duration 10
+    python benchmark.py broker --servers 10 --option fanout=async
+Agent topology (server.py plus agent.py per fake server):
+    python benchmark.py agent --servers 3 --rate 500 --duration 10
+Events recorded with ami_capture.py instead of generated ones:
+    python benchmark.py broker --servers 3 --capture monday.cap --speed 5
+"""
+
+__author__ = 'litnimax@asteriskguru.ru'
+
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import zmq
+
+from ami_capture import read_capture, replay
+from fake_manager import FakeManager
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Run a script with config modules from the current dir instead of BASE_DIR
+LAUNCHER = ("import runpy, sys; sys.path[:0] = ['', %r]; sys.argv.pop(0); "
+            "runpy.run_path(sys.argv[0], run_name='__main__')" % BASE_DIR)
+SETVAR_RE = re.compile(r'(?:DEVICE|PRESENCE)_STATE\((.*)\)')
+DEVICE_STATES = ['INUSE', 'NOT_INUSE', 'RINGING']
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def process_tree_rss(pid):
+    # Sum of RSS in KB of the process and all its children (Linux only)
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % entry).read()
+        except IOError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    total, todo = 0, [pid]
+    while todo:
+        p = todo.pop()
+        todo.extend(children.get(p, []))
+        try:
+            for line in open('/proc/%s/status' % p):
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1])
+        except IOError:
+            pass
+    return total
+
+
+class Benchmark(object):
+    base_port = 40000
+
+    def __init__(self, args):
+        self.args = args
+        self.context = zmq.Context.instance()
+        self.workdir = tempfile.mkdtemp(prefix='zmq-ami-bench-')
+        self.managers = []
+        self.processes = []
+        # {(entity, value): publish time}
+        self.sent = {}
+        self.latencies = []
+        self.published = 0
+        self.expected = 0 # Events that come back as SetVar actions
+
+    def on_action(self, manager, action, received):
+        # Called in fake manager threads
+        match = SETVAR_RE.match(action.get('Variable') or '')
+        if not match:
+            return
+        sent = self.sent.get((match.group(1), action.get('Value')))
+        if sent:
+            self.latencies.append(received - sent)
+
+    def start_managers(self):
+        for i in range(self.args.servers):
+            manager = FakeManager(
+                name='server-%s' % i,
+                cmd_url='tcp://127.0.0.1:%s' % (self.base_port + i * 2),
+                evt_url='tcp://127.0.0.1:%s' % (self.base_port + i * 2 + 1),
+                context=self.context, on_action=self.on_action)
+            manager.latency = self.args.latency
+            manager.fail_rate = self.args.fail_rate
+            manager.record = False
+            # Replay at max speed must not lose events
+            manager.evt_hwm = 0 if self.args.capture else manager.evt_hwm
+            manager.start()
+            self.managers.append(manager)
+
+    def launch(self, script, cwd):
+        stdout = open(os.path.join(cwd, 'output.log'), 'w')
+        process = subprocess.Popen(
+            [sys.executable, '-c', LAUNCHER, os.path.join(BASE_DIR, script)] +
+            ([os.path.join(cwd, 'config.ini')] if script == 'broker.py' else []),
+            cwd=cwd, stdout=stdout, stderr=subprocess.STDOUT,
+            # Own process group to stop multiprocessing children too
+            preexec_fn=os.setsid)
+        self.processes.append(process)
+        return process
+
+    def start_broker(self):
+        cwd = os.path.join(self.workdir, 'broker')
+        os.mkdir(cwd)
+        options = {
+            'device_state': 'yes',
+            'presence': 'yes' if self.args.presence else 'no',
+            'log_level': 'warning',
+            'request_timeout': '1000',
+            'count_messages': 'no',
+            'verbose_messages': 'no',
+        }
+        options.update(o.split('=', 1) for o in self.args.option)
+        lines = ['[general]'] + ['%s = %s' % o for o in sorted(options.items())]
+        lines += ['', '[servers]', 'sections = %s' % ', '.join(
+            'server-%s' % i for i in range(self.args.servers))]
+        for i in range(self.args.servers):
+            lines += ['', '[server-%s]' % i, 'name = server-%s' % i,
+                      'addr = 127.0.0.1',
+                      'cmd_port = %s' % (self.base_port + i * 2),
+                      'evt_port = %s' % (self.base_port + i * 2 + 1),
+                      'ami_trace = no']
+        open(os.path.join(cwd, 'config.ini'), 'w').write('\n'.join(lines) + '\n')
+        self.launch('broker.py', cwd)
+
+    def start_agents(self):
+        esb_port = self.base_port + 1000
+        cwd = os.path.join(self.workdir, 'server')
+        os.mkdir(cwd)
+        open(os.path.join(cwd, 'server_config.py'), 'w').write('\n'.join([
+            "LOG_LEVEL = 'warning'",
+            "PUB_BIND_URL = 'tcp://127.0.0.1:%s'" % esb_port,
+            "PUB_CONNECT_URL = 'tcp://127.0.0.1:%s'" % esb_port,
+            "SUB_BIND_URL = 'tcp://127.0.0.1:%s'" % (esb_port + 1),
+        ] + self.args.option) + '\n')
+        self.launch('server.py', cwd)
+        for i in range(self.args.servers):
+            cwd = os.path.join(self.workdir, 'agent-%s' % i)
+            os.mkdir(cwd)
+            open(os.path.join(cwd, 'agent_config.py'), 'w').write('\n'.join([
+                "LOG_LEVEL = 'warning'",
+                "SYSTEM_NAME = 'server-%s'" % i,
+                "ASTERISK_CMD_URL = 'tcp://127.0.0.1:%s'" % (self.base_port + i * 2),
+                "ASTERISK_EVT_URL = 'tcp://127.0.0.1:%s'" % (self.base_port + i * 2 + 1),
+                "KEEP_ALIVE_INTERVAL = 30",
+                "ZMQ_PUB_URL = 'tcp://127.0.0.1:%s'" % (esb_port + 1),
+                "ZMQ_SUB_URL = 'tcp://127.0.0.1:%s'" % esb_port,
+                "PID_FILE = %r" % os.path.join(cwd, 'agent.pid'),
+            ] + self.args.option) + '\n')
+            self.launch('agent.py', cwd)
+
+    def make_event(self, seq):
+        entity = 'bench-%s' % (seq % self.args.devices if self.args.devices else seq)
+        if self.args.presence and seq % 2:
+            # Subtype makes the value unique to match it on receive
+            key = ('CustomPresence:%s' % entity, 'away,%s' % seq)
+            event = {'Event': 'PresenceStateChange', 'Presentity': key[0],
+                     'Status': 'away', 'Subtype': str(seq)}
+        else:
+            state = DEVICE_STATES[seq % len(DEVICE_STATES)]
+            key = ('Custom:SIP/%s' % entity, state)
+            event = {'Event': 'DeviceStateChange', 'Device': 'SIP/%s' % entity,
+                     'State': state}
+        return key, event
+
+    def capture_key(self, frame):
+        # (entity, value) of SetVar the captured event is distributed as
+        try:
+            event = json.loads(frame)
+        except ValueError:
+            return None
+        if event.get('Event') == 'DeviceStateChange':
+            device = event.get('Device') or ''
+            if device.startswith('Custom:') or (self.args.topology == 'agent' and
+                                                event.get('State') == 'UNKNOWN'):
+                return None
+            return ('Custom:%s' % device, event.get('State'))
+        if event.get('Event') == 'PresenceStateChange' and self.args.presence:
+            return (event.get('Presentity'), '%s,%s' % (event.get('Status'),
+                                                        event.get('Subtype')))
+
+    def replay_capture(self):
+        # Decode before replay not to slow it down
+        frames = list(read_capture(self.args.capture))
+        keys = [self.capture_key(frame) for _, frame in frames]
+
+        def publish(frame):
+            seq = self.published
+            if keys[seq]:
+                self.sent[keys[seq]] = time.time()
+                self.expected += 1
+            self.managers[seq % len(self.managers)].publish_raw(frame)
+            self.published += 1
+
+        return replay(frames, publish, self.args.speed)[1]
+
+    def publish_events(self):
+        if self.args.capture:
+            return self.replay_capture()
+        rate, total = self.args.rate, self.args.rate * self.args.duration
+        start = time.time()
+        for seq in range(total):
+            delay = start + float(seq) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            key, event = self.make_event(seq)
+            self.sent[key] = time.time()
+            self.managers[seq % len(self.managers)].publish(event)
+            self.published += 1
+            self.expected += 1
+        return time.time() - start
+
+    def wait_drain(self, timeout=10):
+        # Wait until deliveries stop coming
+        deadline = time.time() + timeout
+        count = -1
+        while time.time() < deadline and count != len(self.latencies):
+            count = len(self.latencies)
+            time.sleep(1)
+
+    def run(self):
+        try:
+            self.start_managers()
+            if self.args.topology == 'broker':
+                self.start_broker()
+            else:
+                self.start_agents()
+            # Give subscribers time to connect
+            time.sleep(self.args.warmup)
+            start = time.time()
+            sent_time = self.publish_events()
+            self.wait_drain()
+            elapsed = time.time() - start
+            rss = sum(process_tree_rss(p.pid) for p in self.processes)
+            return self.report(sent_time, elapsed, rss)
+        finally:
+            self.stop()
+
+    def report(self, sent_time, elapsed, rss):
+        latencies = [l * 1000 for l in self.latencies]
+        expected = self.expected * (self.args.servers - 1)
+        result = {
+            'topology': self.args.topology,
+            'servers': self.args.servers,
+            'events': self.published,
+            'events_per_sec': round(self.published / sent_time, 1),
+            'deliveries': len(latencies),
+            'expected_deliveries': expected,
+            'deliveries_per_sec': round(len(latencies) / elapsed, 1),
+            'latency_p50_ms': round(percentile(latencies, 50), 2),
+            'latency_p99_ms': round(percentile(latencies, 99), 2),
+            'latency_max_ms': round(max(latencies or [0]), 2),
+            'rss_mb': round(rss / 1024.0, 1),
+        }
+        if self.args.json:
+            print json.dumps(result, sort_keys=True)
+        else:
+            for k in sorted(result):
+                print '%-20s %s' % (k, result[k])
+        return result
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGINT)
+        time.sleep(0.5)
+        for process in self.processes:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            process.wait()
+        for manager in self.managers:
+            manager.stop()
+        if self.args.keep:
+            print 'Logs are kept in %s' % self.workdir
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='zmq-ami-broker benchmark.')
+    parser.add_argument('topology', choices=['broker', 'agent'])
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--rate', type=int, default=100, help='events/sec')
+    parser.add_argument('--duration', type=int, default=10, help='seconds')
+    parser.add_argument('--devices', type=int, default=0,
+                        help='number of devices to rotate, 0 - new one every event')
+    parser.add_argument('--presence', action='store_true',
+                        help='mix in PresenceStateChange (broker only)')
+    parser.add_argument('--latency', type=int, default=0,
+                        help='fake server reply latency, msec')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='part of actions fake servers do not reply')
+    parser.add_argument('--option', action='append', default=[],
+                        help='broker [general] key=value or agent/server config '
+                             'line, can be repeated')
+    parser.add_argument('--capture', help='replay events of ami_capture.py file '
+                                          'instead of generating them')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='capture replay speed, 0 - max speed')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds')
+    parser.add_argument('--json', action='store_true', help='print result as json')
+    parser.add_argument('--keep', action='store_true', help='keep logs')
+    Benchmark(parser.parse_args()).run()
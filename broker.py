@@ -1,14 +1,23 @@
 __author__ = 'litnimax@asteriskguru.ru'
 
+import collections
 import ConfigParser
 import json
 import logging
+import marshal
 import os
+import re
 import string
 import sys
 import time
 import uuid
+import zlib
 import zmq
+from multiprocessing import Process
+
+from util import (BackgroundHandler, EchoSuppressor, EventFilter, Lazy,
+                  LogSampler, Metrics, MetricsCollector, RateLimiter,
+                  StateJournal, push_metrics, serve_metrics, start_thread)
 
 
 class StateBroker:
@@ -16,12 +25,36 @@ class StateBroker:
     device_state = False
     presence = False
     message_count = 0 # Here we count messages sent.
-    presence_change_wait = 3 # We give 3 seconds to exchange presence states.
+    echo_ttl = 3 # We give 3 seconds for servers to echo states we set.
+    echo_max_size = 100000 # Max states remembered to drop their echo.
     servers = [] # Here we put servers from configuration file.
     log_level = logging.DEBUG # python logging level object.
     verbose_messages = False
     request_timeout = 1000 # Timeout in msec for network waiting.
                            # This is only needed if res_zmq_manager cmd event segfaulted.
+    fanout = 'serial' # serial - wait for REP from every server in turn,
+                      # async - DEALER sockets, replies are matched by ActionID.
+    max_inflight = 100 # Max actions awaiting reply per server in async fanout.
+    circuit_threshold = 3 # Consecutive timeouts to stop sending to a server.
+    probe_interval = 5 # Seconds between AMI Ping probes of an open circuit server.
+    coalesce_window = 0 # Msec to hold device state keeping only the latest one, 0 - off.
+    routing = 'broadcast' # broadcast - send to all servers, config - use servers interest
+                          # option, hints - ask servers for their Custom: hints.
+    event_filter = EventFilter() # Byte scan of AMI events before json decoding.
+    filter_log_every = 10000 # Log filter counters every N events.
+    stats_port = 0 # HTTP port of Prometheus metrics, 0 - off.
+    stats_addr = '127.0.0.1'
+    resync_rate = 50 # Actions per second to resync a server coming back, 0 - off.
+    journal_dir = None # Folder to keep states on disk between restarts, None - off.
+    journal_compact_every = 10000 # Journal records to write a new snapshot after.
+    workers = 0 # Ingest and delivery worker processes, 0 - all in one process.
+    ipc_dir = '/tmp' # Folder for ipc sockets between workers.
+    ingest_socket = None # Delivery worker PULL socket for events from ingest workers.
+    log_sample_every = 1 # Log 1 of every N per-message records, 0 - none.
+    log_sample_rate = 100 # Max per-message records a second, 0 - no limit.
+    trace_every = 100 # Trace 1 of every N events to their SetVar replies, 0 - off.
+    max_traced_actions = 10000 # Traced actions remembered, oldest are dropped.
+    hint_re = re.compile(r'Custom:([^&\s"\\,]+)')
     logger = logging.getLogger(__name__)
     # Here we keep sockets for operations
     # Create a context for all.
@@ -31,12 +64,37 @@ class StateBroker:
     # .ini type  configuration
     config_filename = None
     config = ConfigParser.ConfigParser({'ami_trace': 'no'})
-    # PresenceState messages are always sent back so we need a place to account it
-    # {'
-    presence_states = {}
 
 
     def __init__(self, filename=None):
+        # {'Custom:device': [flush time, src_server, action]} in arrival order
+        self.coalesced = collections.OrderedDict()
+        # Lookup tables so the event loop does not scan the servers list
+        self.socket_servers = {} # {evt or cmd socket: server}
+        self.servers_by_id = {} # {server_id: server}
+        # {'Custom:device': set of server_id} - who needs the device state
+        self.interest = {}
+        # Current states of all devices and presentities
+        # {'DEVICE_STATE(Custom:device)': (value, src server_id, device)}
+        self.states = {}
+        self.journal = None
+        # States set on servers are sent back as events, they are not news
+        self.echoes = EchoSuppressor(self.echo_ttl, self.echo_max_size)
+        # {ActionID: event receive time} of traced actions
+        self.traced_actions = collections.OrderedDict()
+        self.decoded_events = 0
+        # Per-message logs go through it
+        self.trace = LogSampler(self.logger, self.log_sample_every,
+                                self.log_sample_rate)
+        # Counters and latencies of broker activity
+        self.metrics = Metrics('zmq_ami_broker', self.logger)
+        self.metrics.set('coalesce_pending', lambda: len(self.coalesced))
+        self.metrics.set('states', lambda: len(self.states))
+        self.metrics.set('echo_entries', lambda: len(self.echoes))
+        self.metrics.set('echoes_suppressed', lambda: self.echoes.suppressed)
+        self.metrics.set('echoes_evicted', lambda: self.echoes.evicted)
+        self.metrics.set('events_filter_accepted', lambda: self.event_filter.accepted)
+        self.metrics.set('events_filter_rejected', lambda: self.event_filter.rejected)
         # Optional filename parameter
         if filename:
             self.config_filename = filename
@@ -63,49 +121,212 @@ class StateBroker:
         self.log_level = eval('logging.%s' % config.get('general',
                                                         'log_level').upper())
         self.socket_timeout = config.get('general', 'request_timeout')
+        self.request_timeout = config.getint('general', 'request_timeout')
+        self.fanout = self._get_option('general', 'fanout', self.fanout)
+        if self.fanout not in ('serial', 'async'):
+            raise Exception('Unknown fanout mode %s' % self.fanout)
+        self.max_inflight = self._get_option('general', 'max_inflight',
+                                             self.max_inflight, config.getint)
+        self.circuit_threshold = self._get_option('general', 'circuit_threshold',
+                                                  self.circuit_threshold,
+                                                  config.getint)
+        self.probe_interval = self._get_option('general', 'probe_interval',
+                                               self.probe_interval,
+                                               config.getfloat)
+        self.coalesce_window = self._get_option('general', 'coalesce_window',
+                                                self.coalesce_window,
+                                                config.getint)
+        self.routing = self._get_option('general', 'routing', self.routing)
+        if self.routing not in ('broadcast', 'config', 'hints'):
+            raise Exception('Unknown routing %s' % self.routing)
+        self.resync_rate = self._get_option('general', 'resync_rate',
+                                            self.resync_rate, config.getfloat)
+        self.echo_ttl = self._get_option('general', 'echo_ttl', self.echo_ttl,
+                                         config.getfloat)
+        self.echo_max_size = self._get_option('general', 'echo_max_size',
+                                              self.echo_max_size, config.getint)
+        self.echoes = EchoSuppressor(self.echo_ttl, self.echo_max_size)
+        self.journal_dir = self._get_option('general', 'journal_dir',
+                                            self.journal_dir) or None
+        self.workers = self._get_option('general', 'workers', self.workers,
+                                        config.getint)
+        self.ipc_dir = self._get_option('general', 'ipc_dir', self.ipc_dir)
+        self.journal_compact_every = self._get_option('general',
+                                                      'journal_compact_every',
+                                                      self.journal_compact_every,
+                                                      config.getint)
+        # Only events we handle are decoded
+        whitelist = self._get_option('general', 'event_whitelist', None)
+        if whitelist:
+            whitelist = [e.strip() for e in whitelist.split(',') if e.strip()]
+        else:
+            whitelist = []
+            if self.device_state:
+                whitelist.append('DeviceStateChange')
+            if self.presence:
+                whitelist.append('PresenceStateChange')
+            if self.routing == 'hints':
+                whitelist.append('Reload')
+            if self.resync_rate:
+                whitelist.append('FullyBooted')
+        self.event_filter = EventFilter(whitelist)
+        self.stats_port = self._get_option('general', 'stats_port',
+                                           self.stats_port, config.getint)
+        self.stats_addr = self._get_option('general', 'stats_addr', self.stats_addr)
         self.count_messages = config.getboolean('general', 'count_messages')
         self.verbose_messages = config.getboolean('general', 'verbose_messages')
+        self.log_sample_every = self._get_option('general', 'log_sample_every',
+                                                 self.log_sample_every,
+                                                 config.getint)
+        self.log_sample_rate = self._get_option('general', 'log_sample_rate',
+                                                self.log_sample_rate,
+                                                config.getfloat)
+        self.trace = LogSampler(self.logger, self.log_sample_every,
+                                self.log_sample_rate)
+        self.trace_every = self._get_option('general', 'trace_every',
+                                            self.trace_every, config.getint)
         # Config servers - strip list of servers.
         server_sections = map(string.strip, config.get('servers', 'sections').split(','))
         # Some magic here - just put all options in a dict.
         for section in server_sections:
-            server = {'server_id': section}
+            server = {'server_id': section, 'health': {
+                'circuit': 'closed',
+                'consecutive_timeouts': 0,
+                'timeouts': 0,
+                'rtt': None, # Last reply time in msec
+                'last_success': None,
+                'opened_at': None,
+                'probe_sent': None,
+                'last_probe': None,
+            }}
             for k, v in config.items(section):
                 server[k] = v
+            # Parse flags once, not on every message
+            server['ami_trace'] = config.getboolean(section, 'ami_trace')
+            # State keys left to resync to the server
+            server['resync'] = collections.deque()
+            if self.resync_rate:
+                server['resync_limiter'] = RateLimiter(self.resync_rate)
             # Add server to servers list.
             self.servers.append(server)
+            self.servers_by_id[section] = server
+            if self.routing == 'config' and server.get('interest'):
+                self._set_interest(server, server['interest'].split(','))
+        self._update_destinations()
 
         # No init loggers after we have configuration
         self._init_logger()
 
 
+    def _get_option(self, section, option, default, getter=None):
+        # Helper func to get optional settings missing in old config files
+        if not self.config.has_option(section, option):
+            return default
+        if getter:
+            return getter(section, option)
+        return self.config.get(section, option)
+
+
     def start(self):
+        if self.workers:
+            self._start_workers()
+            return
+        if self.stats_port:
+            serve_metrics(self.metrics.render, self.stats_port, self.stats_addr)
+            self.logger.info('Metrics on http://%s:%s/metrics' % (
+                self.stats_addr, self.stats_port))
         self._connect_evt_sockets()
-        self._connect_cmd_sockets()
-        self._process_events()
+        self._start_delivery()
 
 
     def _init_logger(self):
         # Just a logger # TODO: Add log to file
         ch = logging.StreamHandler()
         ch.setLevel(self.log_level)
-        self.logger.addHandler(ch)
+        # Console is written in a thread, not from the event loop
+        self.logger.addHandler(BackgroundHandler(ch))
         self.logger.setLevel(self.log_level)
 
 
     def _connect_cmd_sockets(self):
         for server in self.servers:
+            self._connect_cmd_socket(server)
+            name = server['name']
+            self.metrics.set('circuit_open', lambda s=server:
+                             int(s['health']['circuit'] == 'open'), server=name)
+            health = server['health']
+            self.metrics.set('consecutive_timeouts', lambda h=health:
+                             h['consecutive_timeouts'], server=name)
+            # None before the first reply skips the gauge on render
+            self.metrics.set('last_rtt_seconds', lambda h=health:
+                             None if h['rtt'] is None else h['rtt'] / 1000.0,
+                             server=name)
+            self.metrics.set('last_success_timestamp_seconds', lambda h=health:
+                             h['last_success'], server=name)
+            self.metrics.set('resync_pending', lambda s=server:
+                             len(s['resync']), server=name)
+            if self.fanout == 'async':
+                self.metrics.set('queue_depth', lambda s=server:
+                                 len(s['out_queue']), server=name)
+                self.metrics.set('pending_actions', lambda s=server:
+                                 len(s['pending']), server=name)
+
+
+    def _connect_cmd_socket(self, server):
+        endpoint = 'tcp://%s:%s' % (server['addr'], server['cmd_port'])
+        if self.fanout == 'async':
+            socket = self.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(endpoint)
+            # Outbound queue and {ActionID: sent time} of actions waiting for
+            # REP, both survive _reset_dealer()
+            server.setdefault('out_queue', collections.deque())
+            server.setdefault('pending', collections.OrderedDict())
+            # Replies are received in the same loop with AMI events
+            self.event_poll.register(socket, zmq.POLLIN)
+        else:
             socket = self.context.socket(zmq.REQ)
-            endpoint = 'tcp://%s:%s' % (server['addr'], server['cmd_port'])
             socket.connect(endpoint)
-            self.logger.info('Connected to %s commands on %s' % (server['name'],
-                                                        endpoint))
-            # Assign cmd_socket
-            server['cmd_socket'] = socket
+        self.logger.info('Connected to %s commands on %s' % (server['name'],
+                                                    endpoint))
+        # Assign cmd_socket
+        server['cmd_socket'] = socket
+        self.socket_servers[socket] = server
 
 
-    def _connect_evt_sockets(self):
-        for server in self.servers:
+    def _reconnect_cmd_socket(self, server):
+        # Get rid of a dead REQ-REP socket and connect a fresh one
+        socket = server['cmd_socket']
+        del self.socket_servers[socket]
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.close()
+        self.logger.debug('Reconnecting...')
+        self._connect_cmd_socket(server)
+        self.logger.debug('Reconnected to %s and fixing REQ/REP socket state.' %
+                          server['name'])
+
+
+    def _reset_dealer(self, server):
+        # Actions not taken by a dead server stay in DEALER pipe: at HWM
+        # they would block sending to all servers and they would be
+        # replayed stale when it is back. Drop them with the socket.
+        # Replies to pending actions cannot come to a new socket.
+        socket = server['cmd_socket']
+        self.event_poll.unregister(socket)
+        del self.socket_servers[socket]
+        socket.close()
+        pending = server['pending']
+        if pending:
+            self.logger.warning('Dropping %s pending actions for %s.' % (
+                len(pending), server['name']))
+            self.metrics.inc('actions_dropped', len(pending),
+                             server=server['name'])
+            pending.clear()
+        self._connect_cmd_socket(server)
+
+
+    def _connect_evt_sockets(self, servers=None):
+        for server in servers or self.servers:
             socket = self.context.socket(zmq.SUB)
             endpoint = 'tcp://%s:%s' % (server['addr'], server['evt_port'])
             socket.connect(endpoint)
@@ -113,133 +334,676 @@ class StateBroker:
             self.logger.info('Connected to %s events on %s' % (server['name'],
                                                         endpoint))
             server['evt_socket'] = socket
+            self.socket_servers[socket] = server
             self.event_poll.register(socket, zmq.POLLIN)
 
 
+    def _set_interest(self, server, devices):
+        # Replace the list of devices the server has hints for
+        for servers in self.interest.itervalues():
+            servers.discard(server['server_id'])
+        for device in devices:
+            device = device.strip()
+            if not device:
+                continue
+            if not device.startswith('Custom:'):
+                device = 'Custom:' + device
+            self.interest.setdefault(device, set()).add(server['server_id'])
+        self.logger.info('Server %s is interested in %s devices.' % (
+            server['name'], len([d for d, s in self.interest.iteritems()
+                                 if server['server_id'] in s])))
+
+
+    def _load_hints(self, server):
+        # Ask server for hints on a separate REQ socket not to mix
+        # the reply with fanout replies.
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect('tcp://%s:%s' % (server['addr'], server['cmd_port']))
+        poll = zmq.Poller()
+        poll.register(socket, zmq.POLLIN)
+        try:
+            socket.send(json.dumps({
+                'Action': 'Command',
+                'ActionID': uuid.uuid4().hex,
+                'Command': 'core show hints',
+            }))
+            if dict(poll.poll(self.request_timeout)).get(socket) == zmq.POLLIN:
+                # Reply layout differs between Asterisk versions so just
+                # look for Custom: devices in the whole text.
+                self._set_interest(server, self.hint_re.findall(socket.recv()))
+            else:
+                # Keep what we had, unknown devices go to everyone anyway
+                self.logger.error('Did not receive hints from %s' % server['name'])
+        finally:
+            poll.unregister(socket)
+            socket.close()
+
+
     def _get_server_by_socket(self, socket):
         # Helper func to find server by socket
+        return self.socket_servers.get(socket)
+
+
+    def _update_destinations(self):
+        # Prebuild for every server the list of alive servers to send its events to
         for server in self.servers:
-            if socket in [server['cmd_socket'], server['evt_socket']]:
-                return server
+            server['destinations'] = [s for s in self.servers if s is not server
+                                      and s['health']['circuit'] == 'closed']
 
 
-    def _distribute_action(self, src_server, action):
-        # Send to all servers except one that sent the event
-        dst_servers = [s for s in self.servers if s['evt_socket'] != src_server['evt_socket']]
-        self.logger.debug('Dst servers: %s' % ','.join(s['name'] for s in dst_servers))
+    def _distribute_action(self, src_server, action, device=None):
+        # Send to all servers except one that sent the event and dead ones
+        dst_servers = src_server['destinations']
+        # Only to servers having the device in hints if we know them
+        if self.routing != 'broadcast' and device in self.interest:
+            interested = self.interest[device]
+            dst_servers = [s for s in dst_servers if s['server_id'] in interested]
+        self.trace.debug('Dst servers: %s', Lazy(','.join,
+                                                 (s['name'] for s in dst_servers)))
         # Print nice actions
         if self.verbose_messages:
-            self.logger.info('Distribute: %s' % json.dumps(action, indent=1))
-        for dst_server in dst_servers:
-            socket = dst_server['cmd_socket']
+            self.trace.info('Distribute: %s', Lazy(json.dumps, action, indent=1))
+        self._send_action(dst_servers, action)
+
+
+    def _send_action(self, dst_servers, action):
+        # Variable is DEVICE_STATE(entity) or PRESENCE_STATE(entity)
+        entity = action['Variable'][action['Variable'].index('(') + 1:-1]
+        for server in dst_servers:
+            self.echoes.add(server['server_id'], entity, action['Value'])
+        if self.fanout == 'async':
+            self._queue_action(dst_servers, action)
+            return
+        for server in dst_servers:
+            socket = server['cmd_socket']
             poll = zmq.Poller()
             poll.register(socket, zmq.POLLIN)
-            request_retries = 1 # Don't think it would be configured
-            server = self._get_server_by_socket(socket)
-            while request_retries > 0:
-                self.logger.debug('Sending to %s: %s' % (server['name'], action))
-                socket.send(json.dumps(action))
-                socks = dict(poll.poll(self.request_timeout))
-                if socks.get(socket) == zmq.POLLIN:
-                    # Handle recv
-                    reply = socket.recv()
-                    self.logger.debug('Got reply: %s' % reply)
+            self.trace.debug('Sending to %s: %s', server['name'], action)
+            sent = time.time()
+            socket.send(json.dumps(action))
+            self.metrics.inc('actions_sent', server=server['name'])
+            self._trace_hop(action['ActionID'], 'send', sent)
+            socks = dict(poll.poll(self.request_timeout))
+            poll.unregister(socket)
+            if socks.get(socket) == zmq.POLLIN:
+                # Handle recv
+                reply = socket.recv()
+                self.trace.debug('Got reply: %s', reply)
+                self._record_success(server, sent)
+                self._trace_hop(action['ActionID'], 'total')
+            else:
+                # Did not receive
+                self.logger.error('Did not receive REP from %s' %
+                                  server['name'])
+                # As we did not recv reply get rid from a dead REQ-REP socket
+                self._reconnect_cmd_socket(server)
+                self._record_timeout(server)
+
+
+    def _queue_action(self, dst_servers, action):
+        # Async fanout: action is encoded once and put to every server queue
+        data = json.dumps(action)
+        for dst_server in dst_servers:
+            dst_server['out_queue'].append((action['ActionID'], data))
+            self._flush_queue(dst_server)
+
+
+    def _flush_queue(self, server):
+        # Send queued actions while server has free in-flight slots
+        queue, pending = server['out_queue'], server['pending']
+        while queue and len(pending) < self.max_inflight:
+            action_id, data = queue.popleft()
+            self.trace.debug('Sending to %s: %s', server['name'], data)
+            try:
+                # Empty delimiter frame is expected by REP on the other side
+                server['cmd_socket'].send_multipart(['', data], zmq.NOBLOCK)
+            except zmq.Again:
+                # Server does not take actions, never block the events loop
+                self.logger.error('Cannot send to %s, dropping %s' % (
+                    server['name'], action_id))
+                self.metrics.inc('actions_dropped', server=server['name'])
+                self._reset_dealer(server)
+                self._record_timeout(server)
+                continue
+            pending[action_id] = time.time()
+            self.metrics.inc('actions_sent', server=server['name'])
+            self._trace_hop(action_id, 'send', pending[action_id])
+
+
+    def _handle_reply(self, server):
+        # Match DEALER reply with the pending action
+        frames = server['cmd_socket'].recv_multipart()
+        data = frames[-1]
+        self.trace.debug('Got reply from %s: %s', server['name'], data)
+        action_id = None
+        try:
+            reply = json.loads(data)
+            # res_zmq_manager replies with a list of AMI messages
+            if isinstance(reply, list) and reply:
+                reply = reply[0]
+            if isinstance(reply, dict):
+                action_id = reply.get('ActionID')
+        except ValueError:
+            self.logger.error('Unexpected reply from %s receieved: %s' % (
+                server['name'], data))
+        pending = server['pending']
+        if action_id is None and pending:
+            # No ActionID in reply, REP answers in order so it is the oldest one
+            action_id = next(iter(pending))
+        sent = pending.pop(action_id, None)
+        if sent is None:
+            self.logger.debug('Late reply %s from %s ignored.', action_id,
+                              server['name'])
+        else:
+            self._record_success(server, sent)
+            self._trace_hop(action_id, 'total')
+        self._flush_queue(server)
+
+
+    def _trace_action(self, action_id, received):
+        self.traced_actions[action_id] = received
+        if len(self.traced_actions) > self.max_traced_actions:
+            self.traced_actions.popitem(last=False)
+
+
+    def _trace_hop(self, action_id, hop, now=None):
+        # Time from receive of the traced event to the hop: send - after
+        # coalescing and queueing, total - SetVar reply from a server.
+        received = self.traced_actions.get(action_id)
+        if received is not None:
+            self.metrics.observe('trace_hop', (now or time.time()) - received,
+                                 hop=hop)
+
+
+    def _expire_pending(self):
+        # Drop actions that did not get REP in request_timeout
+        now = time.time()
+        timeout = self.request_timeout / 1000.0
+        for server in self.servers:
+            pending = server['pending']
+            expired = False
+            while pending:
+                action_id, sent = next(pending.iteritems())
+                if now - sent < timeout:
+                    break
+                pending.popitem(last=False)
+                self.logger.error('Did not receive REP from %s for %s' % (
+                    server['name'], action_id))
+                self._record_timeout(server)
+                expired = True
+            if expired:
+                self._reset_dealer(server)
+            self._flush_queue(server)
+
+
+    def _record_success(self, server, sent):
+        health = server['health']
+        now = time.time()
+        health['rtt'] = int((now - sent) * 1000)
+        self.metrics.inc('replies', server=server['name'])
+        self.metrics.observe('action_rtt', now - sent, server=server['name'])
+        health['last_success'] = now
+        health['consecutive_timeouts'] = 0
+        if health['circuit'] == 'open':
+            self.logger.warning('Server %s is back after %d seconds, closing circuit.' % (
+                server['name'], now - health['opened_at']))
+            health['circuit'] = 'closed'
+            health['opened_at'] = None
+            health['probe_sent'] = None
+            self._update_destinations()
+            # States changed while it was away are lost
+            self._schedule_resync(server)
+
+
+    def _record_timeout(self, server):
+        health = server['health']
+        health['timeouts'] += 1
+        self.metrics.inc('timeouts', server=server['name'])
+        health['consecutive_timeouts'] += 1
+        if health['circuit'] == 'closed' and \
+                health['consecutive_timeouts'] >= self.circuit_threshold:
+            self.logger.warning('Server %s did not reply %s times, opening circuit.' % (
+                server['name'], health['consecutive_timeouts']))
+            health['circuit'] = 'open'
+            health['opened_at'] = time.time()
+            self._update_destinations()
+            if self.fanout == 'async' and server['out_queue']:
+                self.logger.warning('Dropping %s queued actions for %s.' % (
+                    len(server['out_queue']), server['name']))
+                self.metrics.inc('actions_dropped', len(server['out_queue']),
+                                 server=server['name'])
+                server['out_queue'].clear()
+
+
+    def _probe_servers(self):
+        # Ping open circuit servers to find out when they are back
+        now = time.time()
+        for server in self.servers:
+            health = server['health']
+            if health['circuit'] != 'open':
+                continue
+            if health['probe_sent']:
+                if now - health['probe_sent'] < self.request_timeout / 1000.0:
+                    continue
+                # Probe timed out, async one is counted by _expire_pending()
+                # which also resets the socket
+                health['probe_sent'] = None
+                if self.fanout != 'async':
+                    self.event_poll.unregister(server['cmd_socket'])
+                    self._reconnect_cmd_socket(server)
+                    self._record_timeout(server)
+            if now - health['opened_at'] < self.probe_interval or \
+                    now - (health['last_probe'] or 0) < self.probe_interval:
+                continue
+            self._send_probe(server)
+
+
+    def _send_probe(self, server):
+        health = server['health']
+        action_id = uuid.uuid4().hex
+        data = json.dumps({'Action': 'Ping', 'ActionID': action_id})
+        self.logger.debug('Probing %s.' % server['name'])
+        health['last_probe'] = time.time()
+        if self.fanout == 'async':
+            # Reply goes the usual way and closes circuit on success. Socket
+            # is fresh: it was reset when actions or last probe expired.
+            try:
+                server['cmd_socket'].send_multipart(['', data], zmq.NOBLOCK)
+            except zmq.Again:
+                self._reset_dealer(server)
+                return
+            server['pending'][action_id] = health['last_probe']
+            health['probe_sent'] = health['last_probe']
+        else:
+            # Reply is received in the events loop
+            server['cmd_socket'].send(data)
+            self.event_poll.register(server['cmd_socket'], zmq.POLLIN)
+            health['probe_sent'] = health['last_probe']
+
+
+    def _handle_probe_reply(self, server):
+        # Serial fanout REQ socket got Ping reply
+        health = server['health']
+        self.event_poll.unregister(server['cmd_socket'])
+        reply = server['cmd_socket'].recv()
+        self.logger.debug('Got probe reply from %s: %s' % (server['name'], reply))
+        sent, health['probe_sent'] = health['probe_sent'], None
+        self._record_success(server, sent)
+
+
+    def _store_state(self, src_server, action, device=None):
+        variable = action['Variable']
+        state = (action['Value'], src_server['server_id'], device)
+        if self.states.get(variable) == state:
+            return
+        self.states[variable] = state
+        if self.journal:
+            self.journal.append(variable, state)
+
+
+    def _schedule_resync(self, server):
+        # Queue all current states to be sent to the server
+        if not self.resync_rate or not self.states:
+            return
+        server['resync'] = collections.deque(self.states)
+        self.metrics.inc('resyncs', server=server['name'])
+        self.logger.info('Resync of %s states to %s scheduled.' % (
+            len(server['resync']), server['name']))
+
+
+    def _run_resync(self):
+        # Send queued states at resync_rate so a restarted server is not flooded
+        for server in self.servers:
+            queue = server['resync']
+            if not queue:
+                continue
+            # Dead server will be resynced from the start when it is back
+            while queue and server['health']['circuit'] == 'closed':
+                variable = queue.popleft()
+                if variable not in self.states:
+                    continue
+                value, server_id, device = self.states[variable]
+                # Server knows its own states
+                if server_id == server['server_id']:
+                    continue
+                if self.routing != 'broadcast' and device in self.interest and \
+                        server['server_id'] not in self.interest[device]:
+                    continue
+                if not server['resync_limiter'].take():
+                    queue.appendleft(variable)
                     break
-                else:
-                    # Did not receive
-                    self.logger.error('Did not receive REP from %s' %
-                                      server['name'])
-                    # As we did not recv reply get  rid from a dead REQ-REP socket
-                    socket.setsockopt(zmq.LINGER, 0)
-                    socket.close()
-                    poll.unregister(socket)
-                    request_retries -= 1
-                    # Now reconnect the socket and try again
-                    self.logger.debug('Reconnecting...')
-                    socket = self.context.socket(zmq.REQ)
-                    endpoint = 'tcp://%s:%s' % (server['addr'],
-                                                server['cmd_port'])
-                    socket.connect(endpoint)
-                    server['cmd_socket'] = socket
-                    self.logger.debug('Reconnected to %s and fixing REQ/REP socket state.' % endpoint)
-                    poll.register(socket, zmq.POLLIN)
+                self.metrics.inc('resync_actions', server=server['name'])
+                self._send_action([server], {
+                    'Action': 'Setvar',
+                    'ActionID': uuid.uuid4().hex,
+                    'Variable': variable,
+                    'Value': value,
+                })
+            if not queue:
+                self.logger.info('Resync of %s is done.' % server['name'])
+
+
+    def _coalesce_action(self, src_server, device, action):
+        # Keep only the latest state of the device until the window is over
+        self.metrics.inc('coalesce_received')
+        entry = self.coalesced.get(device)
+        if entry:
+            # Superseded state is never sent, flush time stays the same
+            self.metrics.inc('coalesce_collapsed')
+            entry[1], entry[2] = src_server, action
+        else:
+            flush_time = time.time() + self.coalesce_window / 1000.0
+            self.coalesced[device] = [flush_time, src_server, action]
+
+
+    def _flush_coalesced(self):
+        # Entries are in arrival order so stop at the first one not ready
+        now = time.time()
+        while self.coalesced:
+            device, (flush_time, src_server, action) = next(self.coalesced.iteritems())
+            if flush_time > now:
+                break
+            self.coalesced.popitem(last=False)
+            self.metrics.inc('coalesce_flushed')
+            self._distribute_action(src_server, action, device)
+
+
+    def _poll_timeout(self):
+        # Wake up in time to expire the oldest pending action or flush states
+        deadlines = []
+        if self.fanout == 'async':
+            timeout = self.request_timeout / 1000.0
+            deadlines.extend(next(s['pending'].itervalues()) + timeout
+                             for s in self.servers if s['pending'])
+        if self.coalesced:
+            deadlines.append(next(self.coalesced.itervalues())[0])
+        deadlines.extend(time.time() + s['resync_limiter'].delay()
+                         for s in self.servers if s['resync'] and
+                         s['health']['circuit'] == 'closed')
+        if not deadlines:
+            return self.request_timeout
+        left = (min(deadlines) - time.time()) * 1000
+        return max(0, min(self.request_timeout, int(left) + 1))
+
+
+    def _decode_event(self, src_server, data):
+        # Returns AMI event dict or None if it is not for us
+        self.metrics.inc('events_received', server=src_server['name'])
+        # Traced servers get all their events decoded
+        if not (src_server['ami_trace'] or self.event_filter.accept(data)):
+            filter_count = self.event_filter.rejected + self.event_filter.accepted
+            if filter_count % self.filter_log_every == 0:
+                self.logger.info('Event filter: %s', self.event_filter)
+            return None
+        try:
+            decode_start = time.time()
+            message = json.loads(data)
+            self.metrics.observe('json_decode', time.time() - decode_start)
+            self.decoded_events += 1
+            if self.trace_every and self.decoded_events % self.trace_every == 0:
+                # Goes with the event to a delivery worker too
+                message['_trace'] = decode_start
+        except ValueError:
+            self.logger.error('Unexpected message from %s receieved: %s' % (
+                src_server['name'], data))
+            return None
+        # Trace all AMI messages?
+        if src_server['ami_trace']:
+            self.trace.info('Got message from %s:\n%s.', src_server['name'],
+                            Lazy(json.dumps, message, indent=4))
+        return message
+
+
+    def _handle_event(self, src_server, message):
+        # Handle DeviceStateChange events
+        if message.get('Event') == 'DeviceStateChange' and self.device_state:
+            device = message['Device']
+            # We must distribute only generic channel states not custom,
+            # Custom: ones are mostly echo of what we set.
+            if device.startswith('Custom:'):
+                self.echoes.is_echo(src_server['server_id'], device,
+                                    message.get('State'))
+                return
+            # We must set DEVICE_STATE only on Custom devices
+            device = 'Custom:' + device
+            # Form AMI action
+            action = {
+                'Action': 'Setvar',
+                'ActionID': uuid.uuid4().hex,
+                'Variable': 'DEVICE_STATE(%s)' % device,
+                'Value': '%s' % message['State'],
+            }
+            self._store_state(src_server, action, device=device)
+            if '_trace' in message:
+                self._trace_action(action['ActionID'], message['_trace'])
+            if self.coalesce_window:
+                self._coalesce_action(src_server, device, action)
+            else:
+                self._distribute_action(src_server, action, device)
+
+        # Handle DevicePresenceChange events
+        elif message.get('Event') == 'PresenceStateChange' and self.presence:
+            action = {
+                'Action': 'Setvar',
+                'ActionID': uuid.uuid4().hex,
+                'Variable': 'PRESENCE_STATE(%s)' %
+                            message.get('Presentity'),
+                'Value': '%s,%s' % (
+                    message.get('Status'),
+                    message.get('Subtype')
+                )
+            }
+            # Now check if it is mirrored message
+            if self.echoes.is_echo(src_server['server_id'],
+                                   message.get('Presentity'),
+                                   action['Value']):
+                return
+            self._store_state(src_server, action)
+            if '_trace' in message:
+                self._trace_action(action['ActionID'], message['_trace'])
+            # Now send to other server
+            self._distribute_action(src_server, action)
+
+        # Hints could be changed by dialplan reload
+        elif message.get('Event') == 'Reload' and self.routing == 'hints':
+            self._load_hints(src_server)
+
+        # Asterisk (re)started and has no Custom: states
+        elif message.get('Event') == 'FullyBooted' and self.resync_rate:
+            self._schedule_resync(src_server)
+
+        else:
+            self.trace.debug('Ignoring event: %s', message.get('Event'))
 
 
     def _process_events(self):
         while True:
             try:
-                socks = dict(self.event_poll.poll(self.request_timeout))
+                socks = dict(self.event_poll.poll(self._poll_timeout()))
                 for sock in socks:
                     if not socks[sock] == zmq.POLLIN:
                         continue
 
-                    try:
-                        data = sock.recv()
-                        message = json.loads(data)
-                        # Find the server who owns the socket
-                        src_server = self._get_server_by_socket(sock)
-                        # Trace all AMI messages?
-                        if self.config.getboolean(src_server['server_id'], 'ami_trace'):
-                            self.logger.info('Got message from %s:\n%s.' % (
-                                src_server['name'],
-                                json.dumps(message, indent=4)
-                                )
-                            )
-                        # Handle DeviceStateChange events
-                        if message.get('Event') == 'DeviceStateChange' and self.device_state:
-                            device = message['Device']
-                            # We must distribute only generic channel states not custom
-                            if device.startswith('Custom:'):
-                                continue
-                            # We must set DEVICE_STATE only on Custom devices
-                            device = 'Custom:' + device
-                            # Form AMI action
-                            action = {
-                                'Action': 'Setvar',
-                                'ActionID': uuid.uuid4().hex,
-                                'Variable': 'DEVICE_STATE(%s)' % device,
-                                'Value': '%s' % message['State'],
-                            }
-                            self._distribute_action(src_server, action)
-
-                        # Handle DevicePresenceChange events
-                        elif message.get('Event') == 'PresenceStateChange' and self.presence:
-                            # Now check if it is mirrored message
-                            if self.presence_states.get(message['Presentity']):
-                                # Yes we have it now let see if it is stale, we give 5 seconds for retranslate to complete
-                                if time.time() - self.presence_states[message['Presentity']] < self.presence_change_wait:
-                                    continue
-                                else:
-                                    self.presence_states.pop(message['Presentity'])
-
-                            action = {
-                                'Action': 'Setvar',
-                                'ActionID': uuid.uuid4().hex,
-                                'Variable': 'PRESENCE_STATE(%s)' %
-                                            message.get('Presentity'),
-                                'Value': '%s,%s' % (
-                                    message.get('Status'),
-                                    message.get('Subtype')
-                                )
-                            }
-                            # Add current presence to tracking dictionary
-                            self.presence_states[message.get('Presentity')] = time.time()
-                            # Now send to other server
-                            self._distribute_action(src_server, action)
+                    # Event from an ingest worker
+                    if sock is self.ingest_socket:
+                        server_id, message = marshal.loads(sock.recv())
+                        self._handle_event(self.servers_by_id[server_id], message)
+                        continue
 
+                    # Find the server who owns the socket
+                    src_server = self._get_server_by_socket(sock)
+                    # Reply to async fanout action or probe
+                    if sock is src_server['cmd_socket']:
+                        if self.fanout == 'async':
+                            self._handle_reply(src_server)
                         else:
-                            self.logger.debug('Ignoring event: %s' % message.get('Event'))
+                            self._handle_probe_reply(src_server)
+                        continue
 
-                    except ValueError:
-                        self.logger.error(
-                            'Unexpected message from %s receieved: %s' % (
-                                src_server['name'], data)
-                        )
+                    message = self._decode_event(src_server, sock.recv())
+                    if message is not None:
+                        self._handle_event(src_server, message)
+
+                if self.coalesced:
+                    self._flush_coalesced()
+                if self.fanout == 'async':
+                    self._expire_pending()
+                self._probe_servers()
+                self._run_resync()
 
             except KeyboardInterrupt:
                 break
 
 
+    def _worker_url(self, shard):
+        return 'ipc://%s' % os.path.join(self.ipc_dir, 'zmq-ami-broker-%s-%s.ipc' % (
+            self.main_pid, shard))
+
+
+    def _shard_of(self, message):
+        # Events of one device go to one delivery worker to keep their order,
+        # None - to all workers.
+        event = message.get('Event')
+        if event == 'DeviceStateChange':
+            entity = message.get('Device') or ''
+            if entity.startswith('Custom:'):
+                # Echo goes where the device state was sent from
+                entity = entity[len('Custom:'):]
+        elif event == 'PresenceStateChange':
+            entity = message.get('Presentity') or ''
+        else:
+            return None
+        return zlib.crc32(entity.encode('utf-8')) % self.workers
+
+
+    def _start_workers(self):
+        """
+        Runs ingest and delivery worker processes and waits for them.
+        When a worker exits the others are stopped and the Broker exits
+        with code 1 as the rest cannot work without it.
+        """
+        self.main_pid = os.getpid()
+        processes = []
+        if self.stats_port:
+            collector = MetricsCollector(self.metrics, self._worker_url('stats'))
+            start_thread(collector.run)
+            serve_metrics(collector.render, self.stats_port, self.stats_addr)
+            self.logger.info('Metrics on http://%s:%s/metrics' % (
+                self.stats_addr, self.stats_port))
+        # Delivery workers bind, so start them first
+        for role in ('delivery', 'ingest'):
+            for shard in range(self.workers):
+                process = Process(target=self._run_worker, args=(role, shard),
+                                  name='%s-%s' % (role, shard))
+                process.start()
+                processes.append(process)
+        self.logger.info('Started %s ingest and %s delivery workers.' % (
+            self.workers, self.workers))
+        failed = False
+        try:
+            while not failed:
+                time.sleep(1)
+                for process in processes:
+                    if not process.is_alive():
+                        self.logger.error('Worker %s exited with code %s, stopping.' % (
+                            process.name, process.exitcode))
+                        failed = True
+            for process in processes:
+                process.terminate()
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+        finally:
+            for name in range(self.workers) + ['stats']:
+                path = self._worker_url(name)[len('ipc://'):]
+                if os.path.exists(path):
+                    os.unlink(path)
+        if failed:
+            sys.exit(1)
+
+
+    def _run_worker(self, role, shard):
+        # Forked process must not use parent's sockets
+        self.context = zmq.Context()
+        self.event_poll = zmq.Poller()
+        self.socket_servers = {}
+        if self.stats_port:
+            start_thread(push_metrics, self.metrics, self._worker_url('stats'),
+                         '%s-%s' % (role, shard), 1, self.context)
+        if role == 'ingest':
+            self._ingest(shard)
+        else:
+            self._deliver(shard)
+
+
+    def _ingest(self, shard):
+        # Receive and decode events of every N-th server and pass state
+        # changes to delivery workers.
+        servers = self.servers[shard::self.workers]
+        self._connect_evt_sockets(servers)
+        workers = []
+        for i in range(self.workers):
+            socket = self.context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(self._worker_url(i))
+            workers.append(socket)
+        while True:
+            try:
+                for sock, event in self.event_poll.poll():
+                    src_server = self.socket_servers[sock]
+                    message = self._decode_event(src_server, sock.recv())
+                    if message is None or message.get('Event') not in (
+                            'DeviceStateChange', 'PresenceStateChange',
+                            'Reload', 'FullyBooted'):
+                        continue
+                    # Cheaper to decode than json for the delivery worker
+                    data = marshal.dumps((src_server['server_id'], message))
+                    worker = self._shard_of(message)
+                    if worker is None:
+                        for socket in workers:
+                            socket.send(data)
+                    else:
+                        workers[worker].send(data)
+            except KeyboardInterrupt:
+                break
+
+
+    def _deliver(self, shard):
+        # Keep states and send actions for the shard of devices
+        if self.journal_dir:
+            self.journal_dir = os.path.join(self.journal_dir, 'shard-%s-of-%s' % (
+                shard, self.workers))
+        # Servers are resynced by all workers at once
+        for server in self.servers:
+            if self.resync_rate:
+                server['resync_limiter'] = RateLimiter(
+                    self.resync_rate / float(self.workers))
+        self.ingest_socket = self.context.socket(zmq.PULL)
+        self.ingest_socket.bind(self._worker_url(shard))
+        self.event_poll.register(self.ingest_socket, zmq.POLLIN)
+        self._start_delivery()
+
+
+    def _start_delivery(self):
+        if self.journal_dir:
+            # States are here before the first server connects
+            load_start = time.time()
+            self.journal = StateJournal(self.journal_dir, self.journal_compact_every)
+            self.states = self.journal.load()
+            self.logger.info('Loaded %s states from %s in %.1f msec.' % (
+                len(self.states), self.journal_dir, (time.time() - load_start) * 1000))
+        self._connect_cmd_sockets()
+        if self.routing == 'hints':
+            for server in self.servers:
+                self._load_hints(server)
+        self._process_events()
+        if self.journal:
+            self.journal.close()
+
 
 if __name__ == '__main__':
     if not len(sys.argv) == 2:
@@ -0,0 +1,219 @@
+#!/usr/bin/env python2.7
+"""
+Stand-in for Asterisk res_zmq_manager module to run broker, agent and server
+without real Asterisk boxes.
+
+It has the same 2 sockets:
+* evt - PUB socket publishing AMI events as json;
+* cmd - ROUTER socket accepting AMI actions from REQ and DEALER clients.
+
+Received actions are recorded and can be answered with latency or not
+answered at all to look like a dead server.
+"""
+
+__author__ = 'litnimax@asteriskguru.ru'
+
+import heapq
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+import zmq
+
+STATE_VAR_RE = re.compile(r'(DEVICE|PRESENCE)_STATE\((.*)\)$', re.I)
+
+
+class FakeManager(object):
+    latency = 0 # Msec to hold the reply.
+    jitter = 0 # Random msec added to latency.
+    fail_rate = 0.0 # Part of actions left without reply, 0..1.
+    serial = True # Answer one action at a time like REP socket does.
+    hints = [] # Devices reported by 'core show hints'.
+    echo = False # Publish state change events for DEVICE_STATE / PRESENCE_STATE
+                 # SetVar like Asterisk does.
+    evt_hwm = 1000 # Events queued per subscriber before dropping, 0 - no limit.
+
+    def __init__(self, name='fake', evt_url='tcp://127.0.0.1:30968',
+                 cmd_url='tcp://127.0.0.1:30967', context=None, on_action=None):
+        self.name = name
+        self.evt_url = evt_url
+        self.cmd_url = cmd_url
+        self.context = context or zmq.Context.instance()
+        # Called with (manager, action, receive time) for every action
+        self.on_action = on_action
+        self.actions = [] # [(receive time, action)]
+        self.record = True
+        self.received = 0
+        self.replied = 0
+        self.dropped = 0
+        self.running = False
+        self._control_url = 'inproc://fake-manager-%s' % uuid.uuid4().hex
+        self._local = threading.local()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Run in a background thread
+        self._thread = threading.Thread(target=self.run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+        if not self.running:
+            raise Exception('%s failed to start' % self.name)
+
+    def stop(self):
+        self.running = False
+        if self._thread:
+            self._thread.join()
+
+    def publish(self, event):
+        """
+        Publish AMI event dict, can be called from any thread.
+        """
+        self.publish_raw(json.dumps(event))
+
+    def publish_raw(self, data):
+        """
+        Publish AMI event frame as is, e.g. one from a capture file.
+        """
+        sock = getattr(self._local, 'sock', None)
+        if sock is None:
+            sock = self.context.socket(zmq.PUSH)
+            sock.connect(self._control_url)
+            self._local.sock = sock
+        sock.send(data)
+
+    def _reply_for(self, action):
+        name = action.get('Action', '').lower()
+        reply = {'Response': 'Success', 'ActionID': action.get('ActionID')}
+        if name == 'ping':
+            reply.update({'Ping': 'Pong', 'Timestamp': '%.6f' % time.time()})
+        elif name == 'command':
+            reply['Output'] = '\n'.join(
+                '%s@default : %s&Custom:%s State:Idle' % (i, d, d)
+                for i, d in enumerate(self.hints, 100))
+        else:
+            reply['Message'] = 'Variable Set'
+        return [reply]
+
+    def _echo_for(self, action):
+        match = STATE_VAR_RE.match(action.get('Variable') or '')
+        if not match:
+            return None
+        func, entity = match.groups()
+        if func == 'DEVICE':
+            return {'Event': 'DeviceStateChange', 'Device': entity,
+                    'State': action.get('Value')}
+        status, _, subtype = (action.get('Value') or '').partition(',')
+        return {'Event': 'PresenceStateChange', 'Presentity': entity,
+                'Status': status, 'Subtype': subtype, 'Message': ''}
+
+    def run(self):
+        evt_sock = self.context.socket(zmq.PUB)
+        evt_sock.setsockopt(zmq.LINGER, 0)
+        evt_sock.setsockopt(zmq.SNDHWM, self.evt_hwm)
+        cmd_sock = self.context.socket(zmq.ROUTER)
+        cmd_sock.setsockopt(zmq.LINGER, 0)
+        control = self.context.socket(zmq.PULL)
+        try:
+            evt_sock.bind(self.evt_url)
+            cmd_sock.bind(self.cmd_url)
+            control.bind(self._control_url)
+        except zmq.ZMQError:
+            # Let start() know
+            self._ready.set()
+            raise
+        poll = zmq.Poller()
+        poll.register(cmd_sock, zmq.POLLIN)
+        poll.register(control, zmq.POLLIN)
+        # Heap of (reply time, seq, envelope frames, reply data)
+        replies = []
+        seq = 0
+        busy_until = 0
+        self.running = True
+        self._ready.set()
+        try:
+            while self.running:
+                timeout = 100
+                if replies:
+                    timeout = max(0, int((replies[0][0] - time.time()) * 1000))
+                socks = dict(poll.poll(timeout))
+                if socks.get(control) == zmq.POLLIN:
+                    while True:
+                        try:
+                            evt_sock.send(control.recv(zmq.NOBLOCK))
+                        except zmq.Again:
+                            break
+                if socks.get(cmd_sock) == zmq.POLLIN:
+                    while True:
+                        try:
+                            frames = cmd_sock.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        now = time.time()
+                        self.received += 1
+                        action = json.loads(frames[-1])
+                        if self.record:
+                            self.actions.append((now, action))
+                        if self.on_action:
+                            self.on_action(self, action, now)
+                        event = self.echo and self._echo_for(action)
+                        if event:
+                            self.publish(event)
+                        if random.random() < self.fail_rate:
+                            self.dropped += 1
+                            continue
+                        delay = (self.latency + random.random() * self.jitter) / 1000.0
+                        if self.serial:
+                            # Next action waits for the previous one
+                            busy_until = max(busy_until, now) + delay
+                            reply_at = busy_until
+                        else:
+                            reply_at = now + delay
+                        seq += 1
+                        heapq.heappush(replies, (reply_at, seq, frames[:-1],
+                                                 json.dumps(self._reply_for(action))))
+                now = time.time()
+                while replies and replies[0][0] <= now:
+                    _, _, envelope, data = heapq.heappop(replies)
+                    cmd_sock.send_multipart(envelope + [data])
+                    self.replied += 1
+        finally:
+            evt_sock.close()
+            cmd_sock.close()
+            control.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Fake res_zmq_manager.')
+    parser.add_argument('--addr', default='127.0.0.1')
+    parser.add_argument('--cmd-port', type=int, default=30967)
+    parser.add_argument('--evt-port', type=int, default=30968)
+    parser.add_argument('--latency', type=int, default=0, help='reply latency, msec')
+    parser.add_argument('--jitter', type=int, default=0, help='random latency, msec')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='part of actions not replied, 0..1')
+    parser.add_argument('--hints', default='', help='comma separated devices')
+    parser.add_argument('--echo', action='store_true',
+                        help='publish state change events for SetVar')
+    args = parser.parse_args()
+    manager = FakeManager(evt_url='tcp://%s:%s' % (args.addr, args.evt_port),
+                          cmd_url='tcp://%s:%s' % (args.addr, args.cmd_port))
+    manager.latency, manager.jitter = args.latency, args.jitter
+    manager.fail_rate = args.fail_rate
+    manager.echo = args.echo
+    manager.hints = [h.strip() for h in args.hints.split(',') if h.strip()]
+    manager.record = False
+    manager.on_action = lambda m, action, t: sys.stdout.write(
+        '%.6f %s\n' % (t, json.dumps(action)))
+    manager.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        manager.stop()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2.7
+"""
+Pushes a file to agents over ESB in raw binary chunks and resends the
+missing part to agents that report a gap.
+
+    python push_file.py --folder /etc/asterisk extensions.conf
+    python push_file.py --target Moscow --folder /etc/asterisk sip.conf
+"""
+
+__author__ = 'litnimax@asteriskguru.ru'
+
+import argparse
+import os
+import sys
+import time
+
+import zmq
+
+import agent_config as config
+from util import *
+
+
+def push_file(args):
+    origin = 'push_file-%s' % os.getpid()
+    context = zmq.Context.instance()
+    pub_socket = context.socket(zmq.PUSH)
+    pub_socket.connect(args.pub_url)
+    sub_socket = context.socket(zmq.SUB)
+    sub_socket.setsockopt(zmq.SUBSCRIBE, '[%s]' % origin)
+    sub_socket.connect(args.sub_url)
+    # Let SUB connect before agents start to reply
+    time.sleep(0.5)
+    transfer = send_file(pub_socket, '[%s]' % args.target, origin, args.folder,
+                         args.file, chunk_size=args.chunk_size * 1024,
+                         file_name=args.name)
+    print 'Sent %s as transfer %s' % (args.file, transfer)
+    poll = zmq.Poller()
+    poll.register(sub_socket, zmq.POLLIN)
+    results = {}
+    deadline = time.time() + args.wait
+    while time.time() < deadline:
+        if not poll.poll(int((deadline - time.time()) * 1000)):
+            break
+        target, msg = sub_socket.recv_multipart()[:2]
+        status = load_message(msg)
+        if status.msg_type != 'FileStatus' or status.x_transfer != transfer:
+            continue
+        if status.x_status == 'resume':
+            print '%s: resending from %s' % (status.origin, status.x_offset)
+            send_file(pub_socket, '[%s]' % status.origin, origin, args.folder,
+                      args.file, transfer=transfer, offset=status.x_offset,
+                      chunk_size=args.chunk_size * 1024, file_name=args.name)
+            continue
+        results[status.origin] = status.x_status
+        print '%s: %s' % (status.origin, status.x_status)
+        if args.target != '*':
+            break
+    pub_socket.close()
+    sub_socket.close()
+    return all(r == 'done' for r in results.values()) and results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Push file to agents.')
+    parser.add_argument('file')
+    parser.add_argument('--folder', required=True, help='folder on agents')
+    parser.add_argument('--name', help='file name on agents')
+    parser.add_argument('--target', default='*', help='agent SYSTEM_NAME or *')
+    parser.add_argument('--chunk-size', type=int, default=256, help='KB')
+    parser.add_argument('--wait', type=float, default=10,
+                        help='seconds to wait for agents to report')
+    parser.add_argument('--pub-url', default=config.ZMQ_PUB_URL)
+    parser.add_argument('--sub-url', default=config.ZMQ_SUB_URL)
+    sys.exit(0 if push_file(parser.parse_args()) else 1)
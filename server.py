@@ -6,6 +6,8 @@ from multiprocessing import Process
 from urlparse import urljoin
 import requests
 import sys
+import threading
+import time
 import zmq
 
 import server_config as config
@@ -13,28 +15,138 @@ from util import *
 
 context = zmq.Context()
 
+CAPTURE_URL = 'inproc://esb-capture'
+metrics = Metrics('zmq_ami_esb')
+# Agents known by their heartbeats, served as peer_* metrics
+peers = PeerTable(metrics)
+HEARTBEAT_INTERVAL = getattr(config, 'HEARTBEAT_INTERVAL', 0.5)
+HEARTBEAT_TIMEOUT = getattr(config, 'HEARTBEAT_TIMEOUT', 2)
+
+
+def update_peers(logger, heartbeat):
+    if peers.update(heartbeat):
+        logger.info('Agent %s is up.', heartbeat.origin)
+    for name in peers.check():
+        logger.warning('Agent %s is down.', name)
+
+
+def esb_monitor(logger, context):
+    """
+    Gets a copy of every forwarded message from the proxy and logs
+    counters and sampled messages out of the forwarding path.
+    """
+    sample_every = getattr(config, 'LOG_SAMPLE_EVERY', 100)
+    trace = LogSampler(logger, sample_every, getattr(config, 'LOG_SAMPLE_RATE', 100))
+    stats_interval = getattr(config, 'STATS_INTERVAL', 60)
+    sock = context.socket(zmq.SUB)
+    sock.setsockopt(zmq.SUBSCRIBE, '')
+    sock.connect(CAPTURE_URL)
+    count, last_count, last_time = 0, 0, time.time()
+    targets = {}
+    while True:
+        frames = sock.recv_multipart()
+        count += 1
+        targets[frames[0]] = targets.get(frames[0], 0) + 1
+        metrics.inc('messages_forwarded', target=frames[0])
+        metrics.inc('bytes_forwarded', sum(len(f) for f in frames), target=frames[0])
+        # Compressed messages are forwarded as is, only counted
+        if frames[1][:1] == COMPRESSED_MAGIC:
+            metrics.inc('messages_compressed_forwarded', target=frames[0])
+        if frames[0] == HEARTBEAT_TOPIC:
+            try:
+                update_peers(logger, load_message(frames[1]))
+            except ValueError, e:
+                metrics.inc('decode_errors', target=frames[0])
+                trace.error('Cannot decode heartbeat: %s', e)
+        elif trace.sample():
+            try:
+                zmq_msg = load_message(frames[1])
+                logger.info('Message %s from %s to %s, uuid %s (1 of %s).',
+                            zmq_msg.msg_type, zmq_msg.origin, frames[0],
+                            zmq_msg.uuid, sample_every)
+                logger.debug('%s', Lazy(zmq_msg.pprint))
+            except ValueError, e:
+                metrics.inc('decode_errors', target=frames[0])
+                logger.error('Cannot decode message to %s: %s', frames[0], e)
+        # Only traced messages are decoded for the ESB hop
+        if is_traced(frames[1]):
+            try:
+                hops = load_message(frames[1]).x_trace
+                if hops:
+                    trace_hop(metrics, hops, 'esb')
+            except ValueError:
+                pass
+        now = time.time()
+        if now - last_time >= stats_interval:
+            logger.info('Forwarded %s messages, %.1f msg/s, by target: %s' % (
+                count, (count - last_count) / (now - last_time), targets))
+            last_count, last_time = count, now
+
+
 def esb_server():
     try:
         logger = get_logger('esb_server', level=config.LOG_LEVEL)
+        metrics.logger = logger
+        trace = LogSampler(logger, 1, getattr(config, 'LOG_SAMPLE_RATE', 100))
         context = zmq.Context.instance()
         pub_sock = context.socket(zmq.PUB)
         #pub_sock.linger = 0
         pub_sock.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        set_heartbeat(pub_sock, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
         pub_sock.bind(config.PUB_BIND_URL)
         sub_sock = context.socket(zmq.PULL)
+        set_heartbeat(sub_sock, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
         #sub_sock.linger = 0
         #sub_sock.setsockopt(zmq.SUBSCRIBE, '')
         sub_sock.bind(config.SUB_BIND_URL)
         logger.info('Started.')
-        while True:
-            target, msg = sub_sock.recv_multipart()
-            zmq_msg = ZmqMessage()
-            zmq_msg.load(msg)
-            logger.info('Message %s from %s to %s, uuid %s.' % (zmq_msg.msg_type,
-                                                            zmq_msg.origin, target,
-                                                            zmq_msg.uuid))
-            logger.debug('%s' % zmq_msg.pprint())
-            pub_sock.send_multipart([target, msg])
+        stats_port = getattr(config, 'STATS_PORT', 0)
+        if stats_port:
+            serve_metrics(metrics.render, stats_port,
+                          getattr(config, 'STATS_ADDR', '127.0.0.1'))
+        if getattr(config, 'FORWARD_MODE', 'proxy') == 'proxy':
+            # Forward in libzmq without touching the payload. PUB capture
+            # drops copies if the monitor is slow instead of blocking.
+            capture = context.socket(zmq.PUB)
+            capture.bind(CAPTURE_URL)
+            monitor = threading.Thread(target=esb_monitor,
+                                       args=(logger, context))
+            monitor.daemon = True
+            monitor.start()
+            zmq.proxy(sub_sock, pub_sock, capture)
+        else:
+            while True:
+                # Extra frames (e.g. file chunk data) are forwarded as is
+                frames = sub_sock.recv_multipart()
+                target, msg = frames[0], frames[1]
+                metrics.inc('messages_forwarded', target=target)
+                metrics.inc('bytes_forwarded', sum(len(f) for f in frames),
+                            target=target)
+                decode_start = time.time()
+                try:
+                    zmq_msg = load_message(msg)
+                except ValueError, e:
+                    # Newer version or a format we lack, receivers may know it
+                    metrics.inc('decode_errors', target=target)
+                    trace.error('Cannot decode message to %s: %s', target, e)
+                    pub_sock.send_multipart(frames)
+                    continue
+                metrics.observe('message_decode', time.time() - decode_start)
+                if zmq_msg.x_trace:
+                    trace_hop(metrics, zmq_msg.x_trace, 'esb', decode_start)
+                    # Stamped message goes on, so the receive hop starts here.
+                    # Compressed ones are sent uncompressed, it is 1 of N.
+                    if msg[:1] == COMPRESSED_MAGIC:
+                        msg = decompress_message(msg)
+                    zmq_msg._raw = None
+                    frames[1] = zmq_msg.dump(wire_format_of(msg))
+                if target == HEARTBEAT_TOPIC:
+                    update_peers(logger, zmq_msg)
+                elif trace.sample():
+                    logger.info('Message %s from %s to %s, uuid %s.', zmq_msg.msg_type,
+                                zmq_msg.origin, target, zmq_msg.uuid)
+                    logger.debug('%s', Lazy(zmq_msg.pprint))
+                pub_sock.send_multipart(frames)
 
     except KeyboardInterrupt:
         sub_sock.close()
@@ -3,3 +3,17 @@ PUB_BIND_URL = 'tcp://*:55555'
 PUB_CONNECT_URL = 'tcp://127.0.0.1:55555'
 SUB_BIND_URL = 'tcp://*:55556'
 
+# proxy - forward in libzmq and log sampled messages in a thread,
+# inspect - decode and log every message.
+FORWARD_MODE = 'proxy'
+# Log every Nth message in proxy mode, 0 - do not log messages.
+LOG_SAMPLE_EVERY = 100
+# Max logged messages a second in both modes, 0 - no limit.
+LOG_SAMPLE_RATE = 100
+# Seconds between forwarding stats log lines in proxy mode.
+STATS_INTERVAL = 60
+# Prometheus metrics on http://127.0.0.1:STATS_PORT/metrics, 0 - off.
+STATS_PORT = 0
+# ZMQ heartbeats of agent connections, seconds.
+HEARTBEAT_INTERVAL = 0.5
+HEARTBEAT_TIMEOUT = 2
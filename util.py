@@ -1,10 +1,29 @@
+import binascii
+import collections
+import hashlib
 import json
 import logging
+import marshal
+import mmap
+import multiprocessing.util
 import os
+import Queue
 import StringIO
+import string
+import struct
+import threading
+import time
 import uu
 import uuid
+import zlib
 import zmq
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 def get_logger(name, level='info', system_name=None):
     log_level = eval('logging.%s' % level.upper())
@@ -13,27 +32,953 @@ def get_logger(name, level='info', system_name=None):
     ch.setLevel(log_level)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    logger.addHandler(BackgroundHandler(ch))
     logger.setLevel(log_level)
     return logger
 
 
+class BackgroundHandler(logging.Handler):
+    """
+    Queues records and writes them with the target handler in a thread so
+    that receive loops do not wait for the console. Records are formatted
+    by the writer thread, so message args must not be changed after the
+    log call. Records are dropped when the queue is full.
+    """
+    def __init__(self, target, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.reported = 0
+        self.pid = None
+        self.queue = None
+        self.thread = None
+
+    def _start(self):
+        # Forked process gets the queue but not the thread, so every
+        # process starts its own. The target lock could be held by the
+        # parent writer at fork time.
+        if self.pid is not None:
+            self.target.createLock()
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self._write, args=(self.queue,),
+                                       name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        # Processes exit without atexit, multiprocessing runs finalizers
+        multiprocessing.util.Finalize(self, self.close, exitpriority=0)
+
+    def emit(self, record):
+        # Called under the handler lock
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self, queue):
+        while True:
+            record = queue.get()
+            if record is None:
+                break
+            self.target.handle(record)
+            if self.dropped > self.reported and queue.empty():
+                self.target.handle(logging.LogRecord(
+                    record.name, logging.WARNING, __file__, 0,
+                    '%s log records dropped, queue is full.',
+                    (self.dropped - self.reported,), None))
+                self.reported = self.dropped
+
+    def close(self):
+        # Write out what is queued
+        self.acquire()
+        try:
+            thread, self.thread = self.thread, None
+            if thread and self.pid == os.getpid():
+                self.queue.put(None)
+                thread.join(5)
+        finally:
+            self.release()
+        self.target.flush()
+        logging.Handler.close(self)
+
+
+class Lazy(object):
+    """
+    Log message argument computed only if the record is written:
+    logger.debug('Message: %s', Lazy(json.dumps, msg, indent=2))
+    """
+    __slots__ = ('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+class LogSampler(object):
+    """
+    Logs 1 of every N per-message records and at most rate of them per
+    second. Nothing is counted when the logger level drops the record.
+    every = 0 - do not log, rate = 0 - no limit.
+    """
+    def __init__(self, logger, every=1, rate=0):
+        self.logger = logger
+        self.every = every
+        self.limiter = RateLimiter(rate) if rate else None
+        self.count = 0
+        self.skipped = 0
+
+    def sample(self, level=logging.INFO):
+        """
+        Returns True if a record of the level is to be logged now.
+        """
+        if not self.every or not self.logger.isEnabledFor(level):
+            return False
+        self.count += 1
+        if self.count % self.every or (self.limiter and not self.limiter.take()):
+            self.skipped += 1
+            return False
+        return True
+
+    def debug(self, msg, *args):
+        if self.sample(logging.DEBUG):
+            self.logger.debug(msg, *args)
+
+    def info(self, msg, *args):
+        if self.sample(logging.INFO):
+            self.logger.info(msg, *args)
+
+    def error(self, msg, *args):
+        if self.sample(logging.ERROR):
+            self.logger.error(msg, *args)
+
+
+class EventFilter(object):
+    """
+    Rejects AMI events by a byte scan of the raw frame so that
+    only whitelisted events are json decoded.
+    """
+    def __init__(self, events=None):
+        # Event names are looked up as quoted JSON strings. A false match
+        # (e.g. event name in VarSet value) is fine as the decoded message
+        # is checked anyway.
+        self.patterns = ['"%s"' % e for e in events or []]
+        self.accepted = 0
+        self.rejected = 0
+
+    def accept(self, frame):
+        if not self.patterns:
+            self.accepted += 1
+            return True
+        for pattern in self.patterns:
+            if pattern in frame:
+                self.accepted += 1
+                return True
+        self.rejected += 1
+        return False
+
+    def __str__(self):
+        return 'accepted %s, rejected %s' % (self.accepted, self.rejected)
+
+
+class RateLimiter(object):
+    """
+    Token bucket: rate tokens per second, up to burst tokens at once.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """
+        Returns True and spends a token if there is one.
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """
+        Seconds until the next token.
+        """
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def wait(self):
+        while not self.take():
+            time.sleep(self.delay())
+
+
+class EchoSuppressor(object):
+    """
+    Remembers (server, entity, value) of states set on servers for ttl
+    seconds to drop the events servers send back about them. Keeps at most
+    max_size entries, the oldest ones are evicted first.
+    """
+    def __init__(self, ttl=3, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # {(server, entity, value): expire time}, same ttl for all so
+        # insertion order is expiration order.
+        self.entries = collections.OrderedDict()
+        self.suppressed = 0
+        self.evicted = 0
+
+    def _expire(self, now):
+        entries = self.entries
+        while entries and next(entries.itervalues()) <= now:
+            entries.popitem(last=False)
+
+    def add(self, server, entity, value):
+        now = time.time()
+        key = (server, entity, value)
+        # Move to the end with new expire time
+        self.entries.pop(key, None)
+        self.entries[key] = now + self.ttl
+        self._expire(now)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def is_echo(self, server, entity, value):
+        """
+        True if the state was set on the server, it is forgotten then
+        as one set gives one echo.
+        """
+        self._expire(time.time())
+        if self.entries.pop((server, entity, value), None) is None:
+            return False
+        self.suppressed += 1
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class StateJournal(object):
+    """
+    Keeps states on disk: every change is appended to states.journal
+    as a json [key, value] line and the journal is compacted into
+    states.snapshot, a marshal dump of the whole dict, from time to time.
+    """
+    def __init__(self, folder, compact_every=10000):
+        self.folder = folder
+        self.snapshot_path = os.path.join(folder, 'states.snapshot')
+        self.journal_path = os.path.join(folder, 'states.journal')
+        self.compact_every = compact_every # Journal records to compact after.
+        self.states = {}
+        self.journal = None
+        self.records = 0 # Records in the journal
+
+    def _read_journal(self, states):
+        if not os.path.exists(self.journal_path):
+            return 0
+        records = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    # Last line torn by a crash
+                    continue
+                states[key] = tuple(value) if isinstance(value, list) else value
+                records += 1
+        return records
+
+    def load(self):
+        """
+        Returns {key: value} from snapshot and journal. The owner keeps
+        updating this dict, it is what compaction writes.
+        """
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        if os.path.exists(self.snapshot_path):
+            # One C call is much faster than decoding records one by one
+            with open(self.snapshot_path, 'rb') as f:
+                self.states = marshal.load(f)
+        if self._read_journal(self.states):
+            self.compact()
+        else:
+            self.journal = open(self.journal_path, 'ab')
+        return self.states
+
+    def append(self, key, value):
+        self.journal.write(json.dumps([key, value]) + '\n')
+        # Flush to OS so a crashed process loses nothing, no fsync
+        self.journal.flush()
+        self.records += 1
+        if self.records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        # New snapshot is renamed over the old one so there is always one
+        if self.journal:
+            self.journal.close()
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            marshal.dump(self.states, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        self.journal = open(self.journal_path, 'wb')
+        self.records = 0
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+
+# Agents heartbeats go to all agents and ESB monitors
+HEARTBEAT_TOPIC = '[*:heartbeat]'
+
+
+class LinkStats(object):
+    """
+    Liveness and rolling round trip times of a link. The link is down
+    when no reply came for timeout seconds.
+    """
+    def __init__(self, timeout, size=100):
+        self.timeout = timeout
+        self.rtts = collections.deque(maxlen=size)
+        self.last_reply = time.time()
+        self.alive = None # Not known until the first reply or timeout
+        self.failures = 0
+
+    def reply(self, rtt, now=None):
+        """
+        Records a reply, returns True if the link is back.
+        """
+        self.rtts.append(rtt)
+        self.last_reply = now or time.time()
+        back = self.alive is False
+        self.alive = True
+        return back
+
+    def check(self, now=None):
+        """
+        Returns True if the link has just gone down.
+        """
+        if self.alive is not False and \
+                (now or time.time()) - self.last_reply > self.timeout:
+            self.alive = False
+            self.failures += 1
+            return True
+        return False
+
+    def percentile(self, p):
+        """
+        RTT percentile in seconds of the last replies, None if down.
+        """
+        if not self.alive or not self.rtts:
+            return None
+        rtts = sorted(self.rtts)
+        return rtts[min(len(rtts) - 1, int(p / 100.0 * len(rtts)))]
+
+
+class PeerTable(object):
+    """
+    Agents known by their heartbeats. A peer is alive while its heartbeats
+    come within the timeout it announces. With metrics every peer gets
+    peer_* gauges.
+    """
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.peers = {} # {name: peer dict}
+
+    def update(self, heartbeat, now=None):
+        """
+        Returns True if the peer is new or back.
+        """
+        now = now or time.time()
+        name = heartbeat.origin
+        peer = self.peers.get(name)
+        if peer is None:
+            peer = self.peers[name] = {'seq': None, 'lost': 0, 'alive': False}
+            self._add_metrics(name)
+        if peer['seq'] is not None and heartbeat.x_seq > peer['seq'] + 1:
+            peer['lost'] += heartbeat.x_seq - peer['seq'] - 1
+        back = not peer['alive']
+        peer.update(seq=heartbeat.x_seq, seen=now, alive=True,
+                    timeout=heartbeat.x_timeout or 3,
+                    esb_rtt=heartbeat.x_esb_rtt,
+                    asterisk_rtt=heartbeat.x_asterisk_rtt)
+        return back
+
+    def check(self, now=None):
+        """
+        Returns names of peers that have just gone down.
+        """
+        now = now or time.time()
+        down = []
+        for name, peer in self.peers.iteritems():
+            if peer['alive'] and now - peer['seen'] > peer['timeout']:
+                peer['alive'] = False
+                down.append(name)
+        return down
+
+    def table(self, now=None):
+        """
+        {name: {'alive', 'age', 'esb_rtt', 'asterisk_rtt', 'lost'}}
+        """
+        now = now or time.time()
+        return dict((name, {
+            'alive': now - p['seen'] <= p['timeout'],
+            'age': now - p['seen'],
+            'esb_rtt': p['esb_rtt'],
+            'asterisk_rtt': p['asterisk_rtt'],
+            'lost': p['lost']}) for name, p in self.peers.items())
+
+    def _add_metrics(self, name):
+        if not self.metrics:
+            return
+        peer = lambda: self.table()[name]
+        self.metrics.set('peer_alive', lambda: int(peer()['alive']), peer=name)
+        self.metrics.set('peer_heartbeat_age_seconds', lambda: peer()['age'],
+                         peer=name)
+        self.metrics.set('peer_heartbeats_lost', lambda: peer()['lost'], peer=name)
+        # None of a link that is down skips the gauge on render
+        self.metrics.set('peer_esb_rtt_seconds',
+                         lambda: peer()['esb_rtt'], peer=name)
+        self.metrics.set('peer_asterisk_rtt_seconds',
+                         lambda: peer()['asterisk_rtt'], peer=name)
+
+
+class Metrics(object):
+    """
+    Counters, gauges and latency histograms of a process rendered
+    in Prometheus text format.
+    """
+    # Histogram buckets in seconds
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self, prefix, logger=None):
+        self.prefix = prefix
+        self.logger = logger or logging.getLogger(prefix)
+        self.failed = set() # Gauges already logged as failing
+        self.lock = threading.Lock()
+        self.counters = {} # {(name, labels): value}
+        self.gauges = {} # {(name, labels): value or callable}
+        self.histograms = {} # {(name, labels): [bucket counts, sum, count]}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        Sets gauge value, value can be a function called on render.
+        """
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def snapshot(self, **labels):
+        """
+        Returns json-able copy to send to another process, labels are added
+        to every metric.
+        """
+        extra = tuple(sorted(labels.items()))
+        with self.lock:
+            counters = [(n, l + extra, v) for (n, l), v in self.counters.items()]
+            histograms = [(n, l + extra, [list(h[0]), h[1], h[2]])
+                          for (n, l), h in self.histograms.items()]
+        gauges = []
+        for (n, l), v in self.gauges.items():
+            try:
+                value = v() if callable(v) else v
+            except Exception:
+                # Bug in the gauge, log it once and render the rest
+                if (n, l) not in self.failed:
+                    self.failed.add((n, l))
+                    self.logger.exception('Gauge %s%s failed' % (n, l))
+                continue
+            # None - no value yet, e.g. RTT of a link that is down
+            if value is not None:
+                gauges.append((n, l + extra, value))
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def render(self, snapshots=None):
+        """
+        Prometheus text format of this process or of snapshots.
+        """
+        snapshots = snapshots or [self.snapshot()]
+        lines, types = [], set()
+
+        def labels_text(labels, extra=()):
+            items = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')) for k, v in list(labels) + list(extra)]
+            return '{%s}' % ','.join(items) if items else ''
+
+        def add_type(name, kind):
+            if name not in types:
+                types.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        # Samples of one metric must go together
+        counters, gauges, histograms = [], [], []
+        for snapshot in snapshots:
+            counters.extend(snapshot['counters'])
+            gauges.extend(snapshot['gauges'])
+            histograms.extend(snapshot['histograms'])
+        for name, labels, value in sorted(counters):
+            name = '%s_%s_total' % (self.prefix, name)
+            add_type(name, 'counter')
+            lines.append('%s%s %s' % (name, labels_text(labels), value))
+        for name, labels, value in sorted(gauges):
+            name = '%s_%s' % (self.prefix, name)
+            add_type(name, 'gauge')
+            lines.append('%s%s %s' % (name, labels_text(labels), value))
+        for name, labels, (counts, total, count) in sorted(histograms):
+            name = '%s_%s_seconds' % (self.prefix, name)
+            add_type(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket%s %s' % (name, labels_text(
+                    labels, [('le', bound)]), cumulative))
+            lines.append('%s_bucket%s %s' % (name, labels_text(
+                labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (name, labels_text(labels), total))
+            lines.append('%s_count%s %s' % (name, labels_text(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsCollector(object):
+    """
+    Keeps the latest metrics snapshots pushed by other processes.
+    """
+    def __init__(self, metrics, url, context=None):
+        self.metrics = metrics
+        self.snapshots = {} # {process: snapshot}
+        self.context = context or zmq.Context.instance()
+        self.url = url
+
+    def run(self):
+        sock = self.context.socket(zmq.PULL)
+        sock.bind(self.url)
+        while True:
+            process, snapshot = sock.recv_multipart()
+            self.snapshots[process] = json.loads(snapshot)
+
+    def render(self):
+        return self.metrics.render([self.metrics.snapshot()] +
+                                   self.snapshots.values())
+
+
+def push_metrics(metrics, url, process, interval=1, context=None):
+    """
+    Sends metrics snapshot to MetricsCollector every interval seconds,
+    run it in a thread.
+    """
+    sock = (context or zmq.Context.instance()).socket(zmq.PUSH)
+    sock.setsockopt(zmq.LINGER, 0)
+    # Old snapshots are useless, do not queue them
+    sock.setsockopt(zmq.SNDHWM, 1)
+    sock.connect(url)
+    while True:
+        time.sleep(interval)
+        try:
+            sock.send_multipart([process, json.dumps(
+                metrics.snapshot(process=process))], zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+
+def serve_metrics(render, port, addr='127.0.0.1'):
+    """
+    Starts HTTP thread serving render() result on /metrics.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/metrics'):
+                self.send_error(404)
+                return
+            body = render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((addr, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def trace_hop(metrics, trace, hop, now=None):
+    """
+    Adds the hop time to trace {hop: timestamp} and records the time since
+    the previous hop as trace_hop histogram of the hop. Hops are stamped
+    on different hosts, their clocks must be in sync (NTP).
+    """
+    now = now or time.time()
+    if trace:
+        metrics.observe('trace_hop', max(0, now - max(trace.itervalues())),
+                        hop=hop)
+    trace[hop] = now
+
+
+def set_heartbeat(socket, interval, timeout):
+    """
+    Turns on ZMTP heartbeats (libzmq 4.2+) so a connection to a dead peer
+    is dropped in timeout seconds and not after TCP keepalive time.
+    """
+    if interval and hasattr(zmq, 'HEARTBEAT_IVL'):
+        socket.setsockopt(zmq.HEARTBEAT_IVL, int(interval * 1000))
+        socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, int(timeout * 1000))
+        # Peer drops us if we are silent that long
+        socket.setsockopt(zmq.HEARTBEAT_TTL, int(timeout * 1000))
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+# Binary wire format:
+# magic, version, body codec, uuid (16 bytes), msg_type code, origin length,
+# origin, [msg_type length, msg_type if code is 255], body with x_ fields.
+# JSON messages always start with '{' so receivers detect the format
+# by the first byte and mixed deployments keep working.
+BINARY_MAGIC = '\xb1'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('!cBB16sBB')
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+# Message types known to all versions, index is the wire code. Append only!
+MSG_TYPES = ['AsteriskEvent', 'AsteriskAction', 'AsteriskActionStatus',
+             'AsteriskConfig', 'AgentPing', 'AgentPong', 'FileChunk',
+             'FileStatus', 'AsteriskEventBatch', 'AgentHeartbeat']
+CUSTOM_MSG_TYPE = 255
+WIRE_FORMATS = ('json', 'binary', 'msgpack')
+
+
+def _utf8(value):
+    # Byte strings (e.g. SYSTEM_NAME in a config file) are sent as they are
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def encode_message(data, wire_format='json'):
+    """
+    Encodes message dict with msg_type, uuid, origin and x_ fields.
+    """
+    if wire_format == 'json':
+        return json.dumps(data)
+    if wire_format not in WIRE_FORMATS:
+        raise ValueError('Unknown wire format %s' % wire_format)
+    body = dict((k, v) for k, v in data.iteritems() if k.startswith('x_'))
+    if wire_format == 'msgpack':
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        codec, body = CODEC_MSGPACK, msgpack.packb(body, use_bin_type=True)
+    else:
+        codec, body = CODEC_JSON, json.dumps(body, separators=(',', ':'))
+    msg_type = _utf8(data.get('msg_type') or '')
+    origin = _utf8(data.get('origin') or '')
+    uuid_hex = data.get('uuid') or '0' * 32
+    # strip() leaves something only if there is a non-hex char
+    if len(uuid_hex) != 32 or uuid_hex.strip(string.hexdigits):
+        raise ValueError('uuid must be 32 hex chars: %r' % uuid_hex)
+    if len(origin) > 255 or len(msg_type) > 255:
+        raise ValueError('origin and msg_type must be up to 255 bytes')
+    try:
+        type_code, type_name = MSG_TYPES.index(msg_type), ''
+    except ValueError:
+        type_code = CUSTOM_MSG_TYPE
+        type_name = struct.pack('!B', len(msg_type)) + msg_type
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, codec,
+                                binascii.unhexlify(uuid_hex),
+                                type_code, len(origin))
+    return ''.join([header, origin, type_name, body])
+
+
+def decode_message(msg):
+    """
+    Decodes message in any wire format, compressed or not, to dict.
+    """
+    if msg[:1] == COMPRESSED_MAGIC:
+        msg = decompress_message(msg)
+    if msg[:1] != BINARY_MAGIC:
+        return json.loads(msg)
+    try:
+        magic, version, codec, uuid_bytes, type_code, origin_len = \
+            BINARY_HEADER.unpack_from(msg)
+    except struct.error:
+        raise ValueError('Truncated binary message')
+    if version != BINARY_VERSION:
+        raise ValueError('Unsupported binary message version %s' % version)
+    pos = BINARY_HEADER.size
+    origin = msg[pos:pos + origin_len].decode('utf-8')
+    pos += origin_len
+    if type_code == CUSTOM_MSG_TYPE:
+        type_len = ord(msg[pos])
+        msg_type = msg[pos + 1:pos + 1 + type_len].decode('utf-8')
+        pos += 1 + type_len
+    elif type_code < len(MSG_TYPES):
+        msg_type = MSG_TYPES[type_code]
+    else:
+        raise ValueError('Unknown message type code %s' % type_code)
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        data = msgpack.unpackb(msg[pos:], raw=False)
+    elif codec == CODEC_JSON:
+        data = json.loads(msg[pos:])
+    else:
+        raise ValueError('Unknown message codec %s' % codec)
+    data.update({
+        'msg_type': msg_type,
+        'uuid': binascii.hexlify(uuid_bytes),
+        'origin': origin or None,
+    })
+    return data
+
+
+def new_uuid():
+    # Same 32 hex chars as uuid4().hex but several times cheaper
+    return binascii.hexlify(os.urandom(16))
+
+
+def wire_format_of(msg):
+    if msg[:1] == COMPRESSED_MAGIC:
+        return 'compressed'
+    if msg[:1] != BINARY_MAGIC:
+        return 'json'
+    return 'msgpack' if msg[2:3] == chr(CODEC_MSGPACK) else 'binary'
+
+
+# Compressed wire format: magic, dictionary id, flags, zlib stream of the
+# message in any other wire format. Agents compress what they send when
+# COMPRESS_THRESHOLD is set, all receivers decompress, the ESB forwards
+# messages as is.
+COMPRESSED_MAGIC = '\xb2'
+COMPRESSED_HEADER = struct.Struct('!cBB')
+COMPRESSED_TRACED = 1 # Flag of messages with x_trace, see is_traced().
+# Preset dictionaries, id 0 is plain zlib. Never change a dictionary, add
+# a new id: receivers need the very one the sender used.
+DICTIONARIES = {
+    # Pieces of typical messages in json and binary formats, the most
+    # frequent ones last as they are cheaper to refer to.
+    1: ''.join([
+        '{"msg_type": "AsteriskConfig", "x_file_name": "extensions.conf", '
+        '"x_folder": "/etc/asterisk", "x_operation": "PUT", "x_file_data": "begin 644 ',
+        '{"msg_type": "FileChunk", "x_transfer": "", "x_offset": 0, "x_size": '
+        '"x_crc": "x_file_sha1": "FileStatus", "x_status": "done", "resume", ',
+        '{"origin": "Moscow", "uuid": "", "msg_type": "AgentPing"}'
+        '{"origin": "Moscow", "uuid": "", "msg_type": "AgentPong"}',
+        '{"origin": "Moscow", "x_data": {"Action": "Ping", "Timestamp": "1427887232.481723", '
+        '"Response": "Success", "Ping": "Pong", "ActionID": "", "Message": "Variable Set"}, '
+        '"uuid": "", "msg_type": "AsteriskActionStatus"}',
+        '{"origin": "Moscow", "x_seq": 1, "x_sent": 1427887232.481723, "uuid": "", '
+        '"msg_type": "AgentHeartbeat", "x_timeout": 2, "x_esb_rtt": 0.001, '
+        '"x_asterisk_rtt": null}',
+        '"Event": "PresenceStateChange", "Presentity": "CustomPresence:", '
+        '"Status": "available", "Subtype": "", "Message": ""}',
+        '"x_trace": {"event": 1427887232.481723, "publish": 1427887232.481723}',
+        '{"origin": "Moscow", "x_events": [{"Device": "SIP/100", "State": "INUSE", '
+        '"Event": "DeviceStateChange"}, {"Device": "SIP/101", "State": "NOT_INUSE", '
+        '"Event": "DeviceStateChange"}], "uuid": "", "msg_type": "AsteriskEventBatch"}',
+        '{"x_events":[{"Device":"SIP/100","State":"RINGING","Event":"DeviceStateChange"},'
+        '{"Device":"SIP/101","State":"ONHOLD","Event":"DeviceStateChange"}]}',
+        '{"x_data":{"Device":"SIP/100","State":"UNAVAILABLE","Event":"DeviceStateChange"}}',
+        '{"origin": "Moscow", "x_data": {"Device": "SIP/100", "State": "RINGINUSE", '
+        '"Event": "DeviceStateChange"}, "uuid": "", "msg_type": "AsteriskEvent"}',
+        '{"origin": "Moscow", "x_data": {"Device": "SIP/100", "State": "NOT_INUSE", '
+        '"Event": "DeviceStateChange"}, "uuid": "", "msg_type": "AsteriskEvent"}',
+    ]),
+}
+DICTIONARY_ID = 1 # Used by Compressor
+
+
+class PresetDictionary(object):
+    """
+    zlib with a preset dictionary. Python 2 zlib has no zdict, so the
+    compressor and the decompressor are primed with the dictionary once
+    and copied for every message, the primed part of the stream is not
+    sent. Small window and memory level keep the copy cheap, messages
+    over max_size bytes do not see the dictionary anyway.
+    """
+    wbits = 12
+    mem_level = 5
+
+    def __init__(self, dictionary, level=6):
+        self.max_size = (1 << self.wbits) - len(dictionary)
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, self.wbits,
+                                           self.mem_level)
+        primer = self.compressor.compress(dictionary) + \
+            self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.decompressor = zlib.decompressobj(self.wbits)
+        self.decompressor.decompress(primer)
+
+    def compress(self, data):
+        compressor = self.compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        decompressor = self.decompressor.copy()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
+_preset_dictionaries = dict((i, PresetDictionary(d))
+                            for i, d in DICTIONARIES.iteritems())
+
+
+def decompress_message(msg):
+    """
+    Returns message of the compressed wire format in its inner format.
+    """
+    try:
+        magic, dictionary_id, flags = COMPRESSED_HEADER.unpack_from(msg)
+    except struct.error:
+        raise ValueError('Truncated compressed message')
+    try:
+        if dictionary_id == 0:
+            return zlib.decompress(msg[COMPRESSED_HEADER.size:])
+        if dictionary_id not in _preset_dictionaries:
+            raise ValueError('Unknown compression dictionary %s' % dictionary_id)
+        return _preset_dictionaries[dictionary_id].decompress(
+            msg[COMPRESSED_HEADER.size:])
+    except zlib.error, e:
+        raise ValueError('Cannot decompress message: %s' % e)
+
+
+def is_traced(msg):
+    """
+    Tells if raw message has x_trace without decoding it.
+    """
+    if msg[:1] == COMPRESSED_MAGIC:
+        return len(msg) > 2 and bool(ord(msg[2]) & COMPRESSED_TRACED)
+    return 'x_trace' in msg
+
+
+class Compressor(object):
+    """
+    Compresses dumped messages of at least threshold bytes, see
+    ZmqMessage.compressor. Messages up to max_size of the preset dictionary
+    (about 2 KB) are compressed with it, larger ones (e.g. AsteriskConfig)
+    with plain zlib.
+    Counts bytes before and after, and time spent, to metrics.
+    """
+    def __init__(self, threshold=128, level=6, metrics=None):
+        self.threshold = threshold
+        self.level = level
+        self.metrics = metrics
+        self.dictionary = PresetDictionary(DICTIONARIES[DICTIONARY_ID], level)
+
+    def compress(self, raw, traced=False):
+        msg = raw
+        if len(raw) >= self.threshold:
+            start = time.time()
+            if len(raw) <= self.dictionary.max_size:
+                dictionary_id, data = DICTIONARY_ID, self.dictionary.compress(raw)
+            else:
+                dictionary_id, data = 0, zlib.compress(raw, self.level)
+            compressed = COMPRESSED_HEADER.pack(
+                COMPRESSED_MAGIC, dictionary_id,
+                COMPRESSED_TRACED if traced else 0) + data
+            # Already compressed data only grows
+            if len(compressed) < len(raw):
+                msg = compressed
+            if self.metrics:
+                self.metrics.observe('message_compress', time.time() - start)
+                self.metrics.inc('messages_compressed', int(msg is compressed))
+        if self.metrics:
+            # Ratio of the link is compress_bytes_in / compress_bytes_out
+            self.metrics.inc('compress_bytes_in', len(raw))
+            self.metrics.inc('compress_bytes_out', len(msg))
+        return msg
+
+
 class ZmqMessage(object):
-    _data = {}
-    uuid = None
+    """
+    Base message. Subclasses declare their x_ fields in fields and
+    __slots__ so instances have fixed layout and no __dict__.
+    Any message can carry x_trace {hop: timestamp}, see trace_hop().
+    """
+    __slots__ = ('uuid', 'origin', '_raw', '_extra', 'x_trace')
+    wire_format = 'json' # Format used by dump(), load() accepts any.
+    compressor = None # Compressor of dump(), load() accepts compressed messages.
     msg_type = None
-    origin = None
+    fields = () # x_ fields sent with the message
+    # Immutable messages cache their encoded bytes, do not change them
+    # after dump() or load().
+    immutable = False
+
+    def __new__(cls, *args, **kwargs):
+        # Base class loads any message and keeps its msg_type as it did
+        # before message classes got __slots__
+        if cls is ZmqMessage:
+            cls = UnknownMessage
+        return object.__new__(cls)
 
     def __init__(self, origin=None, message=None):
-        self.uuid = uuid.uuid4().hex
+        self.uuid = new_uuid()
         self.origin = origin
+        self._raw = None
+        self._extra = None
+        self.x_trace = None
+        for field in self.fields:
+            setattr(self, field, None)
         if message:
             self.load(message)
 
     def load(self, msg):
-        msg = json.loads(msg)
-        for k in msg.keys():
-            self.__dict__[k] = msg[k]
+        self._load_data(decode_message(msg), msg)
+
+    def _load_data(self, data, msg):
+        self.uuid = data.pop('uuid', None)
+        self.origin = data.pop('origin', None)
+        self.x_trace = data.pop('x_trace', None)
+        data.pop('msg_type', None)
+        for k, v in data.iteritems():
+            if k in self.fields:
+                setattr(self, k, v)
+            elif k.startswith('x_'):
+                # Fields from newer versions are kept to be sent further
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[k] = v
+        if self.immutable:
+            self._raw = (wire_format_of(msg), msg)
 
 
     def _set_data(self):
@@ -42,13 +987,25 @@ class ZmqMessage(object):
             'uuid': self.uuid,
             'origin': self.origin
         }
-        for k in [k for k in self.__dict__.keys() if k.startswith('x_')]:
-            data[k] = self.__dict__[k]
-        self._data = data
+        for k in self.fields:
+            data[k] = getattr(self, k)
+        # Sent only by traced messages
+        if self.x_trace is not None:
+            data['x_trace'] = self.x_trace
+        if self._extra:
+            data.update(self._extra)
         return data
 
-    def dump(self):
-        return json.dumps(self._set_data())
+    def dump(self, wire_format=None):
+        wire_format = wire_format or self.wire_format
+        if self._raw and self._raw[0] == wire_format:
+            return self._raw[1]
+        raw = encode_message(self._set_data(), wire_format)
+        if self.compressor:
+            raw = self.compressor.compress(raw, self.x_trace is not None)
+        if self.immutable:
+            self._raw = (wire_format, raw)
+        return raw
 
     def json(self):
         return self._set_data()
@@ -57,21 +1014,37 @@ class ZmqMessage(object):
         data = self._set_data()
         result = {}
         for k in data.keys():
-            result[k] = '%s...' % data[k][:100] if data[k] and len(data[k]) > 100 else data[k]
+            # Only strings are long, x_ fields can be numbers and dicts too
+            result[k] = '%s...' % data[k][:100] if isinstance(data[k], basestring) \
+                and len(data[k]) > 100 else data[k]
         return json.dumps(result, indent=2, sort_keys=True)
 
 
+class UnknownMessage(ZmqMessage):
+    """
+    Message of a type this version does not know.
+    """
+    __slots__ = ('msg_type',)
+
+    def __init__(self, origin=None, message=None):
+        self.msg_type = None
+        super(UnknownMessage, self).__init__(origin=origin, message=message)
+
+    def _load_data(self, data, msg):
+        self.msg_type = data.get('msg_type')
+        super(UnknownMessage, self)._load_data(data, msg)
+
+
 class FileMessage(ZmqMessage):
-    x_file_name = None
-    x_file_data = ''
-    x_folder = None
-    x_operation = None
+    __slots__ = fields = ('x_file_name', 'x_file_data', 'x_folder', 'x_operation')
 
-    def __init__(self, origin=None, folder=None, file_name=None):
-        super(FileMessage, self).__init__()
-        self.origin = origin
+    def __init__(self, origin=None, folder=None, file_name=None, message=None):
+        super(FileMessage, self).__init__(origin=origin)
         self.x_folder = folder
         self.x_file_name = file_name
+        self.x_file_data = ''
+        if message:
+            self.load(message)
 
 
     def load_file(self, file_path):
@@ -104,34 +1077,289 @@ class FileMessage(ZmqMessage):
 
 
 class AsteriskConfig(FileMessage):
+    __slots__ = ()
     msg_type = 'AsteriskConfig'
 
 
+class FileChunk(ZmqMessage):
+    """
+    Header of a file chunk, raw chunk bytes follow it as the next frame:
+    [target, FileChunk, data].
+    """
+    __slots__ = fields = ('x_transfer', 'x_folder', 'x_file_name', 'x_offset',
+                          'x_size', 'x_crc', 'x_file_sha1')
+    msg_type = 'FileChunk'
+
+
+class FileStatus(ZmqMessage):
+    """
+    Receiver progress: x_status is done, resume (send again from x_offset)
+    or error.
+    """
+    __slots__ = fields = ('x_transfer', 'x_file_name', 'x_offset', 'x_status')
+    msg_type = 'FileStatus'
+    immutable = True
+
+
+def open_mmap(f):
+    # Empty files cannot be mapped
+    if os.fstat(f.fileno()).st_size == 0:
+        return ''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def send_file(socket, target, origin, folder, file_path, transfer=None,
+              offset=0, chunk_size=256 * 1024, file_name=None):
+    """
+    Sends file as raw binary chunks starting from offset.
+    Returns transfer id to resume it later.
+    """
+    transfer = transfer or new_uuid()
+    with open(file_path, 'rb') as f:
+        data = open_mmap(f)
+        size = len(data)
+        try:
+            file_sha1 = hashlib.sha1(data).hexdigest()
+            while True:
+                chunk = data[offset:offset + chunk_size]
+                header = FileChunk(origin=origin)
+                header.x_transfer = transfer
+                header.x_folder = folder
+                header.x_file_name = file_name or os.path.basename(file_path)
+                header.x_offset = offset
+                header.x_size = size
+                header.x_crc = zlib.crc32(chunk) & 0xffffffff
+                header.x_file_sha1 = file_sha1
+                socket.send_multipart([target, header.dump(), chunk])
+                offset += len(chunk)
+                if offset >= size:
+                    break
+        finally:
+            if size:
+                data.close()
+    return transfer
+
+
+class FileReceiver(object):
+    """
+    Writes FileChunk data to <file>.<transfer>.part as it comes and renames
+    it to the file when all data is received and checksum is correct.
+    Part file size is the offset to resume from, so a transfer survives
+    receiver restart.
+    """
+    gap_timeout = 5 # Seconds to ask again for the same lost chunk.
+    expire_after = 3600 # Seconds to keep part file of an abandoned transfer.
+    max_completed = 1000 # Finished transfers remembered to answer late chunks.
+
+    def __init__(self):
+        self.transfers = {} # {transfer: [open part file, last chunk time]}
+        self.gaps = {} # {transfer: (reported offset, time)}
+        self.completed = collections.OrderedDict() # {transfer: (offset, status)}
+
+    def handle(self, header, data, now=None):
+        """
+        Returns FileStatus fields dict when the sender needs to know something.
+        """
+        now = now or time.time()
+        self.expire(now)
+        status = {'x_transfer': header.x_transfer,
+                  'x_file_name': header.x_file_name}
+        last = header.x_offset + len(data) >= header.x_size
+        completed = self.completed.get(header.x_transfer)
+        if completed is not None:
+            # Late resent chunks, answer once at the end of them
+            if last:
+                return dict(status, x_offset=completed[0], x_status=completed[1])
+            return None
+        file_path = os.path.join(header.x_folder, header.x_file_name)
+        part_path = '%s.%s.part' % (file_path, header.x_transfer)
+        transfer = self.transfers.get(header.x_transfer)
+        if transfer is None:
+            if not os.path.isdir(header.x_folder):
+                os.makedirs(header.x_folder)
+            transfer = self.transfers[header.x_transfer] = [
+                open(part_path, 'ab'), now]
+        part = transfer[0]
+        transfer[1] = now
+        received = part.tell()
+        if header.x_offset != received:
+            if header.x_offset < received:
+                # Chunk we already have, tell where we are if sender is done
+                if last:
+                    return dict(status, x_offset=received, x_status='resume')
+                return None
+            # Lost chunk, ask to send again from where we are once, the
+            # following chunks are past the gap too
+            return self._gap(status, header.x_transfer, received, now)
+        if zlib.crc32(data) & 0xffffffff != header.x_crc:
+            return self._gap(status, header.x_transfer, received, now)
+        part.write(data)
+        self.gaps.pop(header.x_transfer, None)
+        received += len(data)
+        if received < header.x_size:
+            return None
+        # All data is here
+        self.abort(header.x_transfer)
+        with open(part_path, 'rb') as f:
+            written = open_mmap(f)
+            sha1 = hashlib.sha1(written).hexdigest()
+            if len(written):
+                written.close()
+        if sha1 != header.x_file_sha1:
+            os.unlink(part_path)
+            return self._complete(status, header.x_transfer, 0, 'error')
+        os.rename(part_path, file_path)
+        return self._complete(status, header.x_transfer, received, 'done')
+
+    def _gap(self, status, transfer, received, now):
+        gap = self.gaps.get(transfer)
+        if gap and gap[0] == received and now - gap[1] < self.gap_timeout:
+            return None
+        self.gaps[transfer] = (received, now)
+        return dict(status, x_offset=received, x_status='resume')
+
+    def _complete(self, status, transfer, offset, result):
+        self.completed[transfer] = (offset, result)
+        while len(self.completed) > self.max_completed:
+            self.completed.popitem(last=False)
+        return dict(status, x_offset=offset, x_status=result)
+
+    def abort(self, transfer):
+        """
+        Closes part file of the transfer and forgets it.
+        """
+        self.gaps.pop(transfer, None)
+        part = self.transfers.pop(transfer, [None])[0]
+        if part:
+            part.close()
+
+    def expire(self, now=None):
+        """
+        Closes and removes part files of transfers without chunks for
+        expire_after seconds.
+        """
+        now = now or time.time()
+        for transfer, (part, last) in self.transfers.items():
+            if now - last >= self.expire_after:
+                self.abort(transfer)
+                try:
+                    os.unlink(part.name)
+                except OSError:
+                    pass
+
+
 class AsteriskAction(ZmqMessage):
+    __slots__ = fields = ('x_data',)
     msg_type = 'AsteriskAction'
-    x_data = {}
+
+    # message stays the second argument as before data was added
+    def __init__(self, origin=None, message=None, data=None):
+        super(AsteriskAction, self).__init__(origin=origin)
+        self.x_data = data if data is not None else {}
+        if message:
+            self.load(message)
 
 
 class AsteriskActionStatus(ZmqMessage):
+    __slots__ = fields = ('x_data',)
     msg_type = 'AsteriskActionStatus'
+    immutable = True
 
-    def __init__(self, origin=None, data=None):
-        super(AsteriskActionStatus, self).__init__()
-        self.origin = origin
+    def __init__(self, origin=None, data=None, message=None):
+        super(AsteriskActionStatus, self).__init__(origin=origin)
         self.x_data = data
+        if message:
+            self.load(message)
 
 
 class AsteriskEvent(ZmqMessage):
+    __slots__ = fields = ('x_data',)
     msg_type = 'AsteriskEvent'
+    immutable = True
 
-    def __init__(self, origin=None, data=None):
-        super(AsteriskEvent, self).__init__()
-        self.origin = origin
+    def __init__(self, origin=None, data=None, message=None):
+        super(AsteriskEvent, self).__init__(origin=origin)
         self.x_data = data
+        if message:
+            self.load(message)
+
+    @classmethod
+    def device_state(cls, origin, device, state, trace=None):
+        """
+        Fast constructor for the DeviceStateChange hot path.
+        """
+        event = object.__new__(cls)
+        event.uuid = new_uuid()
+        event.origin = origin
+        event._raw = event._extra = None
+        event.x_trace = trace
+        event.x_data = {'Event': 'DeviceStateChange', 'Device': device,
+                        'State': state}
+        return event
+
+
+class AsteriskEventBatch(ZmqMessage):
+    """
+    Several AMI events in one message, x_events is a list of event dicts
+    in the order they happened.
+    """
+    __slots__ = fields = ('x_events',)
+    msg_type = 'AsteriskEventBatch'
+    immutable = True
+
+    def __init__(self, origin=None, events=None, message=None):
+        super(AsteriskEventBatch, self).__init__(origin=origin)
+        self.x_events = events if events is not None else []
+        if message:
+            self.load(message)
 
 
 class AgentPing(ZmqMessage):
+    __slots__ = ()
     msg_type = 'AgentPing'
+    immutable = True
 
 class AgentPong(ZmqMessage):
+    __slots__ = ()
     msg_type = 'AgentPong'
+    immutable = True
+
+
+class AgentHeartbeat(ZmqMessage):
+    """
+    Sent by every agent to HEARTBEAT_TOPIC each heartbeat interval. The
+    sender gets it back as ESB round trip, others keep their peer table.
+    x_sent is the sender's time, RTTs are sender's median in seconds,
+    None when the link is down.
+    """
+    __slots__ = fields = ('x_seq', 'x_sent', 'x_timeout', 'x_esb_rtt',
+                          'x_asterisk_rtt')
+    msg_type = 'AgentHeartbeat'
+    immutable = True
+
+    def __init__(self, origin=None, seq=None, sent=None, timeout=None,
+                 esb_rtt=None, asterisk_rtt=None, message=None):
+        super(AgentHeartbeat, self).__init__(origin=origin)
+        self.x_seq = seq
+        self.x_sent = sent
+        self.x_timeout = timeout
+        self.x_esb_rtt = esb_rtt
+        self.x_asterisk_rtt = asterisk_rtt
+        if message:
+            self.load(message)
+
+
+MESSAGE_CLASSES = dict((cls.msg_type, cls) for cls in [
+    AsteriskConfig, AsteriskAction, AsteriskActionStatus, AsteriskEvent,
+    AgentPing, AgentPong, FileChunk, FileStatus, AsteriskEventBatch,
+    AgentHeartbeat])
+
+
+def load_message(msg):
+    """
+    Returns instance of the message class by its msg_type.
+    """
+    data = decode_message(msg)
+    message = MESSAGE_CLASSES.get(data.get('msg_type'), UnknownMessage)()
+    message._load_data(data, msg)
+    return message